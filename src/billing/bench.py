@@ -0,0 +1,204 @@
+import json
+import random
+import platform
+from time import perf_counter
+from decimal import Decimal
+from datetime import datetime, timezone
+from typing import Callable
+
+import networkx as nx
+from cryptography.fernet import Fernet
+
+from misc import add_user
+from fixtures import load_all
+from models.core import session
+from models.accounts import Merchant
+from models.wallets import Wallet, Currency
+from models.transactions import Invoice, Transaction, Attempt, PaymentSystem
+from models.choices import CurrencyCode, TransactionStatus, AttemptStatus, InvoiceStatus
+from services import InvoiceManager, AttemptManager, VisaManager, ConversionMatrix,\
+    conversion_rate_graph, calculate_conv_rate, calculate_rates
+
+
+'''
+    micro-benchmarks of services hot paths, run by `./manage.py bench`
+    against freshly migrated database filled with generated data
+'''
+
+
+def timings(call: Callable[[int], object], repeat: int) -> dict:
+    '''calls `call(i)` `repeat` times, returns per call statistics in milliseconds'''
+    samples = []
+    for i in range(repeat):
+        start = perf_counter()
+        call(i)
+        samples.append((perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'calls': repeat,
+        'mean_ms': sum(samples) / repeat,
+        'median_ms': samples[repeat // 2],
+        'p95_ms': samples[min(int(repeat * 0.95), repeat - 1)],
+        'min_ms': samples[0],
+        'max_ms': samples[-1],
+    }
+
+
+def rates_graph(rnd: random.Random, currencies: int, edges: int) -> nx.DiGraph:
+    '''random rates graph, ids don't clash with currencies stored in db'''
+    nodes = list(range(1000, 1000 + currencies))
+    G = nx.DiGraph()
+    G.add_nodes_from(nodes)
+    while G.number_of_edges() < min(edges, currencies * (currencies - 1)):
+        left, right = rnd.sample(nodes, 2)
+        G.add_edge(left, right, weight=Decimal(rnd.randint(10, 5000)) / 100)
+    return G
+
+
+def populate(s, rnd: random.Random, invoices: int, transactions: int, repeat: int) -> dict:
+    '''
+    Merchant with wallet receiving invoices partially paid by many transactions,
+    payer with wallet in other currency, pending attempts for success & postback runs
+    '''
+    load_all(s)
+    uah, usd = (
+        s.query(Currency.id).filter(Currency.code == code).scalar()
+        for code in (CurrencyCode.uah, CurrencyCode.usd)
+    )
+    system = s.query(PaymentSystem).one()
+
+    suffix = rnd.getrandbits(32)
+    merchant = add_user(Merchant, f'bench_merchant_{suffix}', 'bench', session=s)
+    payer = add_user(Merchant, f'bench_payer_{suffix}', 'bench', session=s)
+    wallet = Wallet(merchant_id=merchant.id, currency_id=usd)
+    payer_wallet = Wallet(merchant_id=payer.id, currency_id=uah, amount=Decimal('1e12'))
+    s.add_all((wallet, payer_wallet))
+    s.commit()
+
+    # big enough for every benchmark to keep paying them
+    created = [
+        Invoice(amount=Decimal('1e9'), to_wallet_id=wallet.id, status=InvoiceStatus.incomplete)
+        for _ in range(invoices)
+    ]
+    s.add_all(created)
+    s.commit()
+
+    history = [
+        Transaction(
+            invoice_id=invoice.id, amount=Decimal('1'), effective_amount=Decimal('1'),
+            status=rnd.choice((TransactionStatus.success, TransactionStatus.fail))
+        )
+        for invoice in created for _ in range(transactions)
+    ]
+    s.add_all(history)
+    s.commit()
+    paid = {invoice.id: Decimal(0) for invoice in created}
+    for t in history:
+        if t.status == TransactionStatus.success:
+            paid[t.invoice_id] += t.effective_amount
+    for invoice in created:
+        invoice.paid_amount = paid[invoice.id]
+    s.add_all(Attempt(
+        transaction_id=t.id, payment_system_id=system.id,
+        status=AttemptStatus.success if t.status == TransactionStatus.success
+        else AttemptStatus.fail
+    ) for t in history)
+    s.commit()
+
+    def pending_attempts():
+        pending = [
+            Transaction(
+                invoice_id=rnd.choice(created).id,
+                amount=Decimal('0.01'), effective_amount=Decimal('0.01')
+            )
+            for _ in range(repeat)
+        ]
+        s.add_all(pending)
+        s.commit()
+        attempts = [Attempt(transaction_id=t.id, payment_system_id=system.id) for t in pending]
+        s.add_all(attempts)
+        s.commit()
+        return [a.id for a in attempts]
+
+    fernet = Fernet(system.decryption_key.encode())
+    return {
+        'currency_id': uah,
+        'invoice_ids': [invoice.id for invoice in created],
+        'payer_id': payer.id,
+        'payer_wallet_id': payer_wallet.id,
+        'attempt_ids': pending_attempts(),
+        'payment_system_id': system.id,
+        'postbacks': [
+            fernet.encrypt(json.dumps({'attempt_id': id, 'status': 'success'}).encode())
+            for id in pending_attempts()
+        ],
+    }
+
+
+def run(
+        currencies: int = 50, edges: int = 200,
+        invoices: int = 100, transactions: int = 20,
+        repeat: int = 200, seed: int = 0
+) -> dict:
+    started_at = datetime.now(timezone.utc)
+    rnd = random.Random(seed)
+    results = {}
+
+    # rates are benchmarked on generated graph, currencies in db are limited by their codes
+    G = rates_graph(rnd, currencies, edges)
+    nodes = list(G.nodes)
+    results['ConversionMatrix'] = timings(lambda i: ConversionMatrix(G), max(repeat // 20, 1))
+
+    token = conversion_rate_graph.pinned.set((None, G, ConversionMatrix(G)))
+    try:
+        pairs = [rnd.sample(nodes, 2) for _ in range(repeat)]
+        results['calculate_conv_rate'] = timings(
+            lambda i: calculate_conv_rate(*pairs[i]), repeat
+        )
+        results['calculate_rates'] = timings(
+            lambda i: calculate_rates(pairs[i][0]), repeat
+        )
+    finally:
+        conversion_rate_graph.pinned.reset(token)
+
+    with session() as s:
+        data = populate(s, rnd, invoices, transactions, repeat)
+    invoice_ids = data['invoice_ids']
+
+    def fetch(i):
+        with InvoiceManager(rnd.choice(invoice_ids)) as manager:
+            manager.fetch()
+
+    def create_transaction(i):
+        with InvoiceManager(rnd.choice(invoice_ids)) as manager:
+            manager.create_transaction(data['currency_id'], effective_amount=Decimal('0.01'))
+
+    def pay_with_wallet(i):
+        with InvoiceManager(rnd.choice(invoice_ids)) as manager:
+            manager.pay_with_wallet(
+                data['payer_id'], data['payer_wallet_id'], effective_amount=Decimal('0.01')
+            )
+
+    def success(i):
+        with AttemptManager(data['attempt_ids'][i]) as manager:
+            manager.success()
+
+    def process_response(i):
+        with VisaManager(data['payment_system_id']) as manager:
+            manager.process_response(data['postbacks'][i])
+
+    results['InvoiceManager.fetch'] = timings(fetch, repeat)
+    results['InvoiceManager.create_transaction'] = timings(create_transaction, repeat)
+    results['InvoiceManager.pay_with_wallet'] = timings(pay_with_wallet, repeat)
+    results['AttemptManager.success'] = timings(success, repeat)
+    results['VisaManager.process_response'] = timings(process_response, repeat)
+
+    return {
+        'started_at': started_at.isoformat(),
+        'python': platform.python_version(),
+        'params': {
+            'currencies': currencies, 'edges': edges, 'invoices': invoices,
+            'transactions': transactions, 'repeat': repeat, 'seed': seed,
+        },
+        'results': results,
+    }
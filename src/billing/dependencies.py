@@ -5,44 +5,92 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, union_all, literal
+from sqlalchemy.ext.asyncio import AsyncSession
 from bcrypt import checkpw
 
-from settings.core import ROOT
-from models.core import session
+from settings.core import ROOT, AUTH_CACHE_TTL, IDEMPOTENCY_CACHE_TTL
+from models.core import unit_of_work
 from models.accounts import Staff, Merchant
+from misc import CredentialsCache, IdempotencyKeys, decode_cursor
 
 
 static_files = StaticFiles(directory=ROOT / 'static')
 templates = Jinja2Templates(directory=ROOT / 'templates')
 security = HTTPBasic(auto_error=False)
+credentials_cache = CredentialsCache(ttl=AUTH_CACHE_TTL)
+idempotency_keys = IdempotencyKeys(ttl=IDEMPOTENCY_CACHE_TTL)
 
 
-def paging(pageIndex: Optional[int] = None, pageSize: Optional[int] = None):
+def paging(
+        pageIndex: Optional[int] = None, pageSize: Optional[int] = None,
+        cursor: Optional[str] = None
+):
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        return {'offset': None, 'limit': pageSize, 'after': after}
     if pageIndex and pageSize:
-        return {'offset': (pageIndex - 1) * pageSize, 'limit': pageSize}
-    return {'offset': None, 'limit': None}
+        return {'offset': (pageIndex - 1) * pageSize, 'limit': pageSize, 'after': None}
+    return {'offset': None, 'limit': None, 'after': None}
 
 
-def db_session():
-    with session() as s:
+async def db_session():
+    async with unit_of_work() as s:
         yield s
 
 
-def try_get_merchant(
+async def authenticate(
+        credentials: Optional[HTTPBasicCredentials],
+        session: AsyncSession
+) -> dict[type, Union[Staff, Merchant]]:
+    '''
+    Looks up staff and merchant accounts with given username in one query,
+    returns those whose password matches. Recently verified credentials
+    are taken from cache, others are checked with bcrypt
+    '''
+    if credentials is None:
+        return {}
+
+    username, password = credentials.username, credentials.password
+    accounts = union_all(*(
+        select(literal(model.__name__).label('model'), model.id, model.password)
+        .filter(model.username == username)
+        for model in (Staff, Merchant)
+    ))
+
+    key = credentials_cache.key(username, password)
+    users = {}
+    for model_name, id, password_hash in (await session.execute(accounts)).all():
+        model = {'Staff': Staff, 'Merchant': Merchant}[model_name]
+        if not credentials_cache.verified(key, password_hash):
+            # bcrypt is cpu bound, keep it off event loop
+            if not await run_in_threadpool(checkpw, password.encode(), password_hash.encode()):
+                continue
+            credentials_cache.add(key, password_hash)
+        users[model] = model(id=id, username=username, password=password_hash)
+    return users
+
+
+async def try_get_account(
         credentials: HTTPBasicCredentials = Depends(security),
-        session: Session = Depends(db_session)
+        session: AsyncSession = Depends(db_session)
 ):
-    if credentials is None:
-        return
+    # resolved once per request, shared by merchant & staff dependencies
+    accounts = await authenticate(credentials, session)
+    # read transaction is ended, so managers can start theirs on this connection
+    await session.commit()
+    return accounts
+
 
-    q = Merchant.username == credentials.username
-    if merchant := session.query(Merchant).filter(q).first():
-        if checkpw(credentials.password.encode(), merchant.password.encode()):
-            return merchant
+async def try_get_merchant(accounts: dict = Depends(try_get_account)):
+    return accounts.get(Merchant)
 
 
-def get_merchant(merchant: Merchant = Depends(try_get_merchant)):
+async def get_merchant(merchant: Merchant = Depends(try_get_merchant)):
     if not merchant:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -52,20 +100,11 @@ def get_merchant(merchant: Merchant = Depends(try_get_merchant)):
     return merchant
 
 
-def try_get_staff(
-        credentials: HTTPBasicCredentials = Depends(security),
-        session: Session = Depends(db_session)
-):
-    if credentials is None:
-        return
-
-    q = Staff.username == credentials.username
-    if staff := session.query(Staff).filter(q).first():
-        if checkpw(credentials.password.encode(), staff.password.encode()):
-            return staff
+async def try_get_staff(accounts: dict = Depends(try_get_account)):
+    return accounts.get(Staff)
 
 
-def get_staff(staff: Staff = Depends(try_get_staff)):
+async def get_staff(staff: Staff = Depends(try_get_staff)):
     if not staff:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -75,7 +114,7 @@ def get_staff(staff: Staff = Depends(try_get_staff)):
     return staff
 
 
-def try_get_user(
+async def try_get_user(
         staff: Optional[Staff] = Depends(try_get_staff),
         merchant: Optional[Merchant] = Depends(try_get_merchant)
 ):
@@ -85,7 +124,7 @@ def try_get_user(
         return merchant
 
 
-def get_user(
+async def get_user(
         user: Union[Staff, Merchant, None] = Depends(try_get_user)
 ):
     if user:
@@ -0,0 +1,308 @@
+import json
+import random
+import asyncio
+import threading
+from time import perf_counter
+from decimal import Decimal
+from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import urljoin
+
+import requests
+from anyio import to_thread, CapacityLimiter
+from requests.auth import _basic_auth_str
+from sqlalchemy import select, text
+
+from misc import add_user
+from fixtures import load_all
+from models.core import session, async_session
+from models.accounts import Merchant, Staff
+from models.wallets import Wallet, Currency
+from models.transactions import Invoice, Transaction, Attempt, PaymentSystem
+from models.choices import CurrencyCode, PaymentSystemType
+from services import make_fernet
+
+
+'''
+    load generator for the whole payment flow, run by `./manage.py loadtest`:
+    pay -> attempt -> postback -> refund, concurrent flows share invoices,
+    so they contend on the same rows the way real payments do
+'''
+
+
+class AsgiClient:
+    '''calls app in-process, requests don't leave event loop'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(
+            self, method: str, path: str, body: bytes = b'', headers: Optional[dict] = None
+    ) -> tuple[int, bytes]:
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': method, 'scheme': 'http', 'root_path': '',
+            'path': path, 'raw_path': path.encode(), 'query_string': b'',
+            'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+            'client': ('127.0.0.1', 0), 'server': ('loadtest', 80),
+        }
+        status, chunks, done, received = None, [], asyncio.Event(), False
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            # streaming responses listen for disconnect while they are sent
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    done.set()
+
+        await self.app(scope, receive, send)
+        return status, b''.join(chunks)
+
+
+class HttpClient:
+    '''sends requests to running server, blocking requests run in threads'''
+
+    def __init__(self, base_url: str, concurrency: int):
+        self.base_url = base_url
+        self.limiter = CapacityLimiter(concurrency)
+        self.local = threading.local()
+
+    async def request(
+            self, method: str, path: str, body: bytes = b'', headers: Optional[dict] = None
+    ) -> tuple[int, bytes]:
+        def send():
+            if (s := getattr(self.local, 'session', None)) is None:
+                s = self.local.session = requests.Session()
+            response = s.request(method, urljoin(self.base_url, path), data=body, headers=headers)
+            return response.status_code, response.content
+
+        return await to_thread.run_sync(send, limiter=self.limiter)
+
+
+def percentile(samples: list[float], q: float) -> float:
+    return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+
+class Stats:
+    '''latencies & errors per endpoint, keyed by route, not by concrete url'''
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, endpoint: str, seconds: float, ok: bool):
+        self.latencies.setdefault(endpoint, []).append(seconds * 1000)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        report = {}
+        for endpoint, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            report[endpoint] = {
+                'requests': len(samples),
+                'errors': self.errors.get(endpoint, 0),
+                'per_second': len(samples) / elapsed,
+                'p50_ms': percentile(samples, 0.5),
+                'p95_ms': percentile(samples, 0.95),
+                'p99_ms': percentile(samples, 0.99),
+                'max_ms': samples[-1],
+            }
+        return report
+
+
+class LockWaitSampler:
+    '''
+    Polls how many backends of the database wait for locks, waiting time
+    is estimated as number of waiting backends times sampling interval
+    '''
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = []
+
+    async def run(self, stop: asyncio.Event):
+        async with async_session() as s:
+            while not stop.is_set():
+                waiting = (await s.execute(text(
+                    "SELECT count(*) FROM pg_stat_activity "
+                    "WHERE datname = current_database() AND wait_event_type = 'Lock'"
+                ))).scalar()
+                await s.commit()
+                self.samples.append(waiting)
+                try:
+                    await asyncio.wait_for(stop.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def report(self) -> dict:
+        return {
+            'samples': len(self.samples),
+            'max_waiting': max(self.samples, default=0),
+            'mean_waiting': sum(self.samples) / len(self.samples) if self.samples else 0,
+            'seconds': sum(self.samples) * self.interval,
+        }
+
+
+def populate(s, rnd: random.Random, invoices: int) -> dict:
+    '''merchant receiving shared invoices, staff reading /metrics, visa payment system'''
+    load_all(s)
+    currency_id = s.query(Currency.id).filter(Currency.code == CurrencyCode.usd).scalar()
+    system = s.query(PaymentSystem)\
+              .filter(PaymentSystem.system_type == PaymentSystemType.visa)\
+              .order_by(PaymentSystem.id)\
+              .first()
+
+    suffix = rnd.getrandbits(32)
+    merchant = add_user(Merchant, f'loadtest_merchant_{suffix}', 'loadtest', session=s)
+    add_user(Staff, f'loadtest_staff_{suffix}', 'loadtest', session=s)
+    wallet = Wallet(merchant_id=merchant.id, currency_id=currency_id)
+    s.add(wallet)
+    s.commit()
+    # never completed, so flows keep paying them
+    created = [Invoice(amount=Decimal('1e9'), to_wallet_id=wallet.id) for _ in range(invoices)]
+    s.add_all(created)
+    s.commit()
+
+    return {
+        'currency_id': currency_id,
+        'tokens': [invoice.token for invoice in created],
+        'payment_system_id': system.id,
+        # postbacks are encrypted with primary key, as emulate_response does
+        'fernet': make_fernet(system.decryption_key),
+        'staff_auth': _basic_auth_str(f'loadtest_staff_{suffix}', 'loadtest'),
+    }
+
+
+async def attempt_id(transaction_token: str) -> int:
+    # attempt ids aren't exposed by api, payment system gets them from payment page
+    async with async_session() as s:
+        return (await s.execute(
+            select(Attempt.id)
+            .join(Transaction, Transaction.id == Attempt.transaction_id)
+            .filter(Transaction.token == transaction_token)
+            .order_by(Attempt.id.desc())
+            .limit(1)
+        )).scalar_one()
+
+
+async def run(
+        url: Optional[str] = None,
+        concurrency: int = 20, flows: int = 500, invoices: int = 5,
+        refund_ratio: float = 0.2, lock_sample_interval: float = 0.05, seed: int = 0
+) -> dict:
+    '''
+    Runs `flows` payment flows by `concurrency` concurrent clients, each flow pays
+    one of `invoices` shared invoices (fewer invoices, more contention).
+    App is called in-process unless `url` of running server is given, both ways
+    it must use the configured database
+    '''
+    rnd = random.Random(seed)
+    with session() as s:
+        data = populate(s, rnd, invoices)
+
+    if url is None:
+        from main import app
+        client = AsgiClient(app)
+    else:
+        client = HttpClient(url, concurrency)
+
+    stats = Stats()
+
+    async def call(endpoint: str, method: str, path: str, payload=None, content=None):
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        body = json.dumps(payload).encode() if payload is not None else (content or b'')
+        start = perf_counter()
+        status, response = await client.request(method, path, body, headers)
+        ok = status == 200
+        stats.add(endpoint, perf_counter() - start, ok)
+        if not ok:
+            raise RuntimeError(f'{method} {path}: {status} {response[:200]!r}')
+        return json.loads(response)
+
+    async def flow(token: str, refund: bool):
+        transaction = await call(
+            'POST /pay/{token}', 'POST', f'/pay/{token}',
+            {'amount': '1', 'currency_id': data['currency_id']}
+        )
+        if 'token' not in transaction:
+            raise RuntimeError(f'transaction not created: {transaction}')
+        await call(
+            'POST /attempt/{token}', 'POST', f'/attempt/{transaction["token"]}',
+            {'payment_system_id': data['payment_system_id']}
+        )
+        postback = data['fernet'].encrypt(json.dumps({
+            'attempt_id': await attempt_id(transaction['token']), 'status': 'success'
+        }).encode())
+        await call(
+            'POST /visa/{payment_system_id}', 'POST',
+            f'/visa/{data["payment_system_id"]}', content=postback
+        )
+        if refund:
+            await call('POST /refund/{token}', 'POST', f'/refund/{transaction["token"]}')
+
+    plan = [(rnd.choice(data['tokens']), rnd.random() < refund_ratio) for _ in range(flows)]
+    completed, failed, errors = 0, 0, {}
+
+    async def worker():
+        nonlocal completed, failed
+        while plan:
+            token, refund = plan.pop()
+            try:
+                await flow(token, refund)
+                completed += 1
+            except Exception as e:
+                failed += 1
+                errors[str(e)[:200]] = errors.get(str(e)[:200], 0) + 1
+
+    async def db_metrics() -> dict:
+        metrics = await client.request(
+            'GET', '/metrics', headers={'Authorization': data['staff_auth']}
+        )
+        return json.loads(metrics[1])
+
+    before = await db_metrics()
+    sampler, stop = LockWaitSampler(lock_sample_interval), asyncio.Event()
+    sampling = asyncio.create_task(sampler.run(stop))
+    started_at, start = datetime.now(timezone.utc), perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - start
+    stop.set()
+    await sampling
+    after = await db_metrics()
+
+    def delta(name: str) -> int:
+        return after.get(name, 0) - before.get(name, 0)
+
+    return {
+        'started_at': started_at.isoformat(),
+        'target': url or 'asgi',
+        'params': {
+            'concurrency': concurrency, 'flows': flows, 'invoices': invoices,
+            'refund_ratio': refund_ratio, 'seed': seed,
+        },
+        'elapsed_s': elapsed,
+        'flows': {
+            'completed': completed, 'failed': failed,
+            'per_second': completed / elapsed, 'errors': errors,
+        },
+        'endpoints': stats.report(elapsed),
+        # counted by server, over http only its worker serving /metrics is seen
+        'db': {
+            'serialization_failures': delta('db.conflicts'),
+            'retries': delta('db.retries'),
+            'unresolved': delta('db.conflicts.unresolved'),
+            'lock_wait': sampler.report(),
+        },
+    }
@@ -70,7 +70,7 @@ def emulate_response(attempt_id, hostname=None):
     from settings.core import HOSTNAME
     from models.transactions import Attempt, PaymentSystem
     from models.core import session
-    from cryptography.fernet import Fernet
+    from services import make_fernet
 
     if hostname is None:
         hostname = HOSTNAME
@@ -90,8 +90,8 @@ def emulate_response(attempt_id, hostname=None):
                            .filter(Attempt.id == attempt_id)\
                            .filter(PaymentSystem.id == Attempt.payment_system_id)\
                            .one()
-        key = system.decryption_key
-        fernet = Fernet(key.encode() if not isinstance(key, bytes) else key)
+        # encrypts with primary key
+        fernet = make_fernet(system.decryption_key)
 
         url = urljoin(HOSTNAME, f'/{system.name}/{system.id}/')
         data = json.dumps({'attempt_id': attempt_id, 'status': status})
@@ -102,6 +102,108 @@ def emulate_response(attempt_id, hostname=None):
         print(f'body: {response.content}')
 
 
+def postback_workers(concurrency=4, batch_size=100, poll_interval=1.0):
+    import asyncio
+    import logging
+
+    from services import process_postbacks
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def worker():
+        while True:
+            try:
+                processed = await process_postbacks(batch_size)
+            except Exception:
+                logging.exception('failed to claim postbacks')
+                processed = 0
+            if not processed:
+                await asyncio.sleep(poll_interval)
+
+    async def main():
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    asyncio.run(main())
+
+
+def compact_wallets(batch_size=100, interval=10.0):
+    import asyncio
+    import logging
+
+    from services import compact_wallets
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def main():
+        while True:
+            try:
+                compacted = await compact_wallets(batch_size)
+            except Exception:
+                logging.exception('failed to compact wallets')
+                compacted = 0
+            # wallets left over from full batch are compacted right away
+            if compacted < batch_size:
+                await asyncio.sleep(interval)
+
+    asyncio.run(main())
+
+
+def bench(output=None, database='bench', **params):
+    '''
+    Recreates `database` next to the configured one, migrates it and runs
+    benchmarks there, see bench.run for params. Results are printed as json
+    or written to `output`
+    '''
+    from os import environ
+    import json
+
+    from plumbum import local
+    from sqlalchemy import create_engine
+
+    from settings.core import ROOT
+
+    url = environ['DATABASE_URL']
+    bench_url = f'{url.rsplit("/", 1)[0]}/{database}'
+    engine = create_engine(f'{environ["SYNC_DRIVER"]}:{url}', isolation_level='AUTOCOMMIT')
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f'DROP DATABASE IF EXISTS {database}')
+        connection.exec_driver_sql(f'CREATE DATABASE {database}')
+    engine.dispose()
+
+    with local.cwd(ROOT / 'models'), local.env(DATABASE_URL=bench_url):
+        local['alembic']('upgrade', 'head')
+
+    # engines are created on import, so app modules are imported after this
+    environ['DATABASE_URL'] = bench_url
+    from bench import run
+
+    results = json.dumps(run(**params), indent=2)
+    if output is None:
+        print(results)
+    else:
+        with open(output, 'w') as f:
+            f.write(results)
+
+
+def loadtest(url=None, output=None, **params):
+    '''
+    Drives payment flow through the app: in-process by default or running
+    server at `url`, see loadtest.run for params. Data is created in the
+    configured database. Results are printed as json or written to `output`
+    '''
+    import asyncio
+    import json
+
+    from loadtest import run
+
+    results = json.dumps(asyncio.run(run(url=url, **params)), indent=2)
+    if output is None:
+        print(results)
+    else:
+        with open(output, 'w') as f:
+            f.write(results)
+
+
 def load_fixtures():
     from models.core import session
     from fixtures import load_all
@@ -0,0 +1,88 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable
+
+
+'''
+    in-process metrics, every worker keeps its own values
+    and exposes them at /metrics
+'''
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount: int = 1):
+        with self.lock:
+            self.value += amount
+
+    def collect(self):
+        return self.value
+
+
+class Histogram:
+    # seconds, upper bounds
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def collect(self):
+        with self.lock:
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'max': self.max,
+                'buckets': dict(zip((*self.buckets, 'inf'), self.counts)),
+            }
+
+
+class Gauge:
+    def __init__(self, callback: Callable[[], float]):
+        self.callback = callback
+
+    def collect(self):
+        return self.callback()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def _get_or_add(self, name: str, factory):
+        if (metric := self.metrics.get(name)) is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, factory())
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get_or_add(name, Counter)
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get_or_add(name, Histogram)
+
+    def gauge(self, name: str, callback: Callable[[], float]) -> Gauge:
+        with self.lock:
+            gauge = self.metrics[name] = Gauge(callback)
+        return gauge
+
+    def snapshot(self) -> dict:
+        return {name: metric.collect() for name, metric in sorted(self.metrics.items())}
+
+
+registry = Registry()
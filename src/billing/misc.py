@@ -1,11 +1,57 @@
-from typing import Union
+import hmac
+import json
+import asyncio
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as BinasciiError
+from os import urandom
+from time import monotonic
+from typing import Union, Optional, Callable, Awaitable
 
 from pydantic import BaseModel
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select, update, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from bcrypt import hashpw, gensalt
 
+from settings.core import COUNT_ESTIMATE_THRESHOLD
 from models.core import session as main_session
 from models.accounts import Staff, Merchant
+from models.transactions import IdempotencyKey
+
+
+def encode_cursor(last_id: int) -> str:
+    return urlsafe_b64encode(json.dumps({'id': last_id}).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    '''Returns id cursor points after, raises ValueError for malformed cursor'''
+    try:
+        last_id = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))['id']
+    except (BinasciiError, UnicodeDecodeError, TypeError, KeyError, json.JSONDecodeError) as e:
+        raise ValueError('Malformed cursor') from e
+    if not isinstance(last_id, int):
+        raise ValueError('Malformed cursor')
+    return last_id
+
+
+async def count_items(session, statement) -> tuple[int, bool]:
+    '''
+    Returns number of rows statement selects and whether it's exact.
+    Planner estimate is used when it's above COUNT_ESTIMATE_THRESHOLD,
+    so large listings aren't scanned just to be counted
+    '''
+    connection = await session.connection()
+    sql = statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    plan = (await connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = plan[0]['Plan']['Plan Rows']
+    if estimate > COUNT_ESTIMATE_THRESHOLD:
+        return estimate, False
+
+    count = select(func.count()).select_from(statement.order_by(None).subquery())
+    return (await session.execute(count)).scalar_one(), True
 
 
 class PaginatedMeta(type):
@@ -15,16 +61,44 @@ class PaginatedMeta(type):
         if ret := cls.__cache.get(key):
             return ret
 
-        def from_queryset(cls, queryset, offset, limit):
-            data = queryset.offset(offset).limit(limit).all()
-            return {'data': data, 'itemsCount': len(data)}
+        async def from_select(cls, session, statement, offset, limit, after=None):
+            '''
+            Pages are ordered by id. With `after` rows are taken right after that id
+            (keyset pagination, cost doesn't depend on depth), otherwise by offset
+            '''
+            page = statement.order_by(key.id)
+            if after is not None:
+                page = page.filter(key.id > after)
+            if limit is not None:
+                # extra row tells if there is a next page
+                page = page.limit(limit + 1)
+            result = await session.execute(page.offset(offset))
+            data = result.scalars().all()
+
+            next_cursor = None
+            if limit is not None and len(data) > limit:
+                data = data[:limit]
+                next_cursor = encode_cursor(data[-1].id)
+
+            if after is None and next_cursor is None and (data or not offset):
+                # last page by offset, everything before it was counted already
+                count, exact = (offset or 0) + len(data), True
+            else:
+                count, exact = await count_items(session, statement)
+
+            return {
+                'data': data, 'itemsCount': count, 'itemsCountExact': exact,
+                'nextCursor': next_cursor
+            }
 
         ret = type(key.__name__, (BaseModel,), {
             '__annotations__': {
                 'data': list[key],
-                'itemsCount': int
+                'itemsCount': int,
+                'itemsCountExact': bool,
+                'nextCursor': Optional[str]
             },
-            'from_queryset': classmethod(from_queryset)
+            'from_select': classmethod(from_select)
         })
 
         cls.__cache[key] = ret
@@ -70,3 +144,127 @@ def add_user(
         s.commit()
 
     return instance
+
+
+class CredentialsCache:
+    '''
+    Remembers credentials that passed bcrypt check for `ttl` seconds.
+    Key is HMAC of username & password with per process secret, so plain
+    passwords are never kept. Entry holds password hash it was verified against,
+    it's valid only while stored hash is the same, so password change
+    (in any worker) invalidates it immediately
+    '''
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.secret = urandom(32)
+        self.entries = {}  # key -> (expires at, password hash)
+
+    def key(self, username: str, password: str) -> bytes:
+        message = b'%d:%s%s' % (len(username), username.encode(), password.encode())
+        return hmac.digest(self.secret, message, 'sha256')
+
+    def verified(self, key: bytes, password_hash: str) -> bool:
+        if (entry := self.entries.get(key)) is None:
+            return False
+        expires_at, verified_hash = entry
+        if expires_at < monotonic():
+            self.entries.pop(key, None)
+            return False
+        return hmac.compare_digest(verified_hash, password_hash)
+
+    def add(self, key: bytes, password_hash: str):
+        now = monotonic()
+        if len(self.entries) >= self.maxsize:
+            self.entries = {k: v for k, v in self.entries.items() if v[0] >= now}
+            if len(self.entries) >= self.maxsize:
+                self.entries.clear()
+        self.entries[key] = (now + self.ttl, password_hash)
+
+
+class IdempotencyConflict(Exception):
+    '''key was already used for different request'''
+
+
+class IdempotencyKeys:
+    '''
+    Runs request handler once per key, later requests with the key get stored response.
+    Key row is inserted in transaction that stays open until handler finishes, so
+    duplicates in other workers block on unique index till response is committed.
+    Duplicates in this worker wait on lock instead, without holding connections, and
+    responses are kept in memory for `ttl` seconds. Failed handler stores nothing
+    '''
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.responses = {}  # (path, key) -> (expires at, request hash, response)
+        self.locks = {}  # (path, key) -> [lock, number of requests using it]
+
+    async def run(
+            self, session, path: str, key: str, request_hash: str,
+            handler: Callable[[], Awaitable]
+    ):
+        entry = self.locks.setdefault((path, key), [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if (cached := self.cached(path, key)) is None:
+                    cached = await self.execute(session, path, key, request_hash, handler)
+                    self.add(path, key, *cached)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[(path, key)]
+
+        stored_hash, response = cached
+        if not hmac.compare_digest(stored_hash, request_hash):
+            raise IdempotencyConflict(key)
+        return response
+
+    async def execute(self, session, path, key, request_hash, handler):
+        inserted = await session.execute(
+            insert(IdempotencyKey)
+            .values(path=path, key=key, request_hash=request_hash)
+            .on_conflict_do_nothing()
+            .returning(IdempotencyKey.id)
+        )
+        if (id := inserted.scalar()) is None:
+            # committed by other request by now
+            row = (await session.execute(
+                select(IdempotencyKey.request_hash, IdempotencyKey.response)
+                .filter(IdempotencyKey.path == path, IdempotencyKey.key == key)
+            )).one()
+            await session.commit()
+            return row.request_hash, json.loads(row.response)
+
+        try:
+            response = jsonable_encoder(await handler())
+        except BaseException:
+            await session.rollback()
+            raise
+        await session.execute(
+            update(IdempotencyKey)
+            .filter(IdempotencyKey.id == id)
+            .values(response=json.dumps(response))
+        )
+        await session.commit()
+        return request_hash, response
+
+    def cached(self, path: str, key: str) -> Optional[tuple[str, object]]:
+        if (entry := self.responses.get((path, key))) is None:
+            return None
+        expires_at, request_hash, response = entry
+        if expires_at < monotonic():
+            self.responses.pop((path, key), None)
+            return None
+        return request_hash, response
+
+    def add(self, path: str, key: str, request_hash: str, response):
+        now = monotonic()
+        if len(self.responses) >= self.maxsize:
+            self.responses = {k: v for k, v in self.responses.items() if v[0] >= now}
+            if len(self.responses) >= self.maxsize:
+                self.responses.clear()
+        self.responses[(path, key)] = (now + self.ttl, request_hash, response)
@@ -38,3 +38,10 @@ class AttemptStatus(str, Enum):
 
 class PaymentSystemType(str, Enum):
     visa = 'visa'
+
+
+class PostbackStatus(str, Enum):
+    pending = 'pending'
+    applied = 'applied'
+    skipped = 'skipped'
+    failed = 'failed'
@@ -1,11 +1,115 @@
+from time import perf_counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
 from sqlmodel import create_engine
+from sqlalchemy import exc
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+
+from metrics import registry
+from .settings import DATABASES, ECHO_SQL, POOLS
+
+
+class TimedPoolMixin:
+    '''
+    Records how long checkouts wait for connection (including pre ping
+    and opening new connections) and how many of them timed out
+    '''
+    metrics_name = None
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            registry.counter(f'db.pool.{self.metrics_name}.timeouts').inc()
+            raise
+        finally:
+            registry.histogram(f'db.pool.{self.metrics_name}.checkout_wait')\
+                    .observe(perf_counter() - start)
+
+
+def timed_pool(base: type, name: str) -> type:
+    # pool is recreated by class on dispose, so name lives in class
+    return type(f'Timed{base.__name__}', (TimedPoolMixin, base), {'metrics_name': name})
+
+
+def register_pool_metrics(name: str, engine):
+    # engine.pool is looked up on every collect, it's replaced on dispose
+    prefix = f'db.pool.{name}'
+    registry.gauge(f'{prefix}.size', lambda: engine.pool.size())
+    registry.gauge(f'{prefix}.checked_out', lambda: engine.pool.checkedout())
+    registry.gauge(f'{prefix}.overflow', lambda: max(engine.pool.overflow(), 0))
+    registry.gauge(f'{prefix}.utilisation', lambda: pool_utilisation(engine.pool))
+
+
+def pool_utilisation(pool) -> float:
+    # share of connections (including overflow ones) currently checked out
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    return pool.checkedout() / capacity if capacity else 0
 
-from .settings import DATABASES
 
+def make_engine(name: str, pool: str, **kwargs):
+    engine = create_engine(
+        DATABASES['sync']['url'], echo=ECHO_SQL,
+        poolclass=timed_pool(QueuePool, name), **POOLS[pool], **kwargs
+    )
+    register_pool_metrics(name, engine)
+    return engine
 
-engine = create_engine(DATABASES['sync']['url'])
-serializable_engine = engine.execution_options(isolation_level="SERIALIZABLE")
+
+def make_async_engine(name: str, pool: str, **kwargs):
+    engine = create_async_engine(
+        DATABASES['async']['url'], echo=ECHO_SQL,
+        poolclass=timed_pool(AsyncAdaptedQueuePool, name), **POOLS[pool], **kwargs
+    )
+    register_pool_metrics(name, engine.sync_engine)
+    return engine
+
+
+engine = make_engine('read', 'read')
+serializable_engine = make_engine('write', 'write', isolation_level="SERIALIZABLE")
 
 session = sessionmaker(engine, expire_on_commit=False)
 serializable_session = sessionmaker(serializable_engine, expire_on_commit=False)
+
+# same options as sync engines, used by request handlers
+async_engine = make_async_engine('async_read', 'read')
+async_serializable_engine = make_async_engine(
+    'async_write', 'write', isolation_level="SERIALIZABLE"
+)
+
+async_session = sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+async_serializable_session = sessionmaker(
+    async_serializable_engine, class_=AsyncSession, expire_on_commit=False
+)
+
+
+# session of request being handled, managers reuse its connection
+request_session = ContextVar('request_session', default=None)
+
+
+@asynccontextmanager
+async def unit_of_work():
+    '''
+    Request scoped session holding single connection for the whole request.
+    Auth & view queries run on it at engine's default level, managers entered
+    while it's active run their transactions on the same connection
+    '''
+    async with async_session.kw['bind'].connect() as connection:
+        async with async_session(bind=connection) as s:
+            # fastapi may exit dependencies in other context than they were entered,
+            # so var isn't reset, emptied holder marks session as closed instead
+            holder = [s]
+            request_session.set(holder)
+            try:
+                yield s
+            finally:
+                holder.clear()
+
+
+def get_request_session() -> Optional[AsyncSession]:
+    return holder[0] if (holder := request_session.get()) else None
@@ -0,0 +1,48 @@
+"""conversion rate version
+
+Revision ID: 3f1d2a7c9b04
+Revises: c766ff809a40
+Create Date: 2026-10-18 10:12:41.302117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1d2a7c9b04'
+down_revision = 'c766ff809a40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'conversion_rate_version',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('version', sa.BigInteger, nullable=False, server_default='0')
+    )
+    op.execute('INSERT INTO conversion_rate_version (id, version) VALUES (1, 0)')
+
+    # statement level triggers, so bulk changes bump version once
+    op.execute('''
+        CREATE FUNCTION bump_conversion_rate_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE conversion_rate_version SET version = version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    for table in ('currency', 'conversion_rate'):
+        op.execute(f'''
+            CREATE TRIGGER {table}_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_conversion_rate_version()
+        ''')
+
+
+def downgrade():
+    for table in ('currency', 'conversion_rate'):
+        op.execute(f'DROP TRIGGER {table}_version ON {table}')
+    op.execute('DROP FUNCTION bump_conversion_rate_version()')
+    op.drop_table('conversion_rate_version')
@@ -0,0 +1,36 @@
+"""invoice paid amount
+
+Revision ID: 5c9a0e3b7f12
+Revises: 8b2e4f6a1d37
+Create Date: 2026-10-18 15:21:09.664213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c9a0e3b7f12'
+down_revision = '8b2e4f6a1d37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('invoice', sa.Column(
+        'paid_amount', sa.Numeric(precision=20, scale=3), nullable=False, server_default='0'
+    ))
+    op.execute('''
+        UPDATE invoice SET paid_amount = paid.amount
+        FROM (
+            SELECT invoice_id, sum(effective_amount) AS amount
+            FROM transaction
+            WHERE status = 'success'
+            GROUP BY invoice_id
+        ) AS paid
+        WHERE invoice.id = paid.invoice_id
+    ''')
+
+
+def downgrade():
+    op.drop_column('invoice', 'paid_amount')
@@ -0,0 +1,45 @@
+"""payment system version
+
+Revision ID: 7d2c5a9e4b81
+Revises: e1f3b8d05a62
+Create Date: 2026-10-18 19:12:48.230915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2c5a9e4b81'
+down_revision = 'e1f3b8d05a62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'payment_system_version',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('version', sa.BigInteger, nullable=False, server_default='0')
+    )
+    op.execute('INSERT INTO payment_system_version (id, version) VALUES (1, 0)')
+
+    op.execute('''
+        CREATE FUNCTION bump_payment_system_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE payment_system_version SET version = version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER payment_system_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON payment_system
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_payment_system_version()
+    ''')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER payment_system_version ON payment_system')
+    op.execute('DROP FUNCTION bump_payment_system_version()')
+    op.drop_table('payment_system_version')
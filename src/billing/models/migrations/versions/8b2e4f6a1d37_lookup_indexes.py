@@ -0,0 +1,48 @@
+"""lookup indexes
+
+Revision ID: 8b2e4f6a1d37
+Revises: 3f1d2a7c9b04
+Create Date: 2026-10-18 14:03:27.519846
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4f6a1d37'
+down_revision = '3f1d2a7c9b04'
+branch_labels = None
+depends_on = None
+
+
+# wallet(merchant_id) lookups are served by uniq_wallet (merchant_id, currency_id)
+INDEXES = (
+    ('ix_transaction_invoice_id_status', 'transaction', ['invoice_id', 'status']),
+    ('ix_invoice_to_wallet_id', 'invoice', ['to_wallet_id']),
+    ('ix_attempt_transaction_id', 'attempt', ['transaction_id']),
+)
+TOKENS = ('invoice', 'transaction', 'attempt')
+
+
+def upgrade():
+    # built concurrently, so payments aren't blocked while tables are indexed
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+        for table in TOKENS:
+            op.create_index(
+                f'uniq_{table}_token', table, ['token'],
+                unique=True, postgresql_concurrently=True
+            )
+            op.drop_index(f'ix_{table}_token', table, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table in TOKENS:
+            op.create_index(f'ix_{table}_token', table, ['token'], postgresql_concurrently=True)
+            op.drop_index(f'uniq_{table}_token', table, postgresql_concurrently=True)
+
+        for name, table, _ in INDEXES:
+            op.drop_index(name, table, postgresql_concurrently=True)
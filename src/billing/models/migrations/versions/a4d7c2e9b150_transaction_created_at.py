@@ -0,0 +1,33 @@
+"""transaction created at
+
+Revision ID: a4d7c2e9b150
+Revises: 5c9a0e3b7f12
+Create Date: 2026-10-18 16:47:52.108354
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d7c2e9b150'
+down_revision = '5c9a0e3b7f12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing transactions get migration time, there is nothing better to date them by
+    op.add_column('transaction', sa.Column(
+        'created_at', sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()
+    ))
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_transaction_created_at', 'transaction', ['created_at'],
+            postgresql_concurrently=True
+        )
+
+
+def downgrade():
+    op.drop_index('ix_transaction_created_at', 'transaction')
+    op.drop_column('transaction', 'created_at')
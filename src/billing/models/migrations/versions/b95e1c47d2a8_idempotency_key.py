@@ -0,0 +1,34 @@
+"""idempotency key
+
+Revision ID: b95e1c47d2a8
+Revises: 7d2c5a9e4b81
+Create Date: 2026-10-18 20:31:06.457128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b95e1c47d2a8'
+down_revision = '7d2c5a9e4b81'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'idempotency_key',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('key', sa.String(255), nullable=False),
+        sa.Column('path', sa.String(255), nullable=False),
+        sa.Column('request_hash', sa.String(64), nullable=False),
+        sa.Column('response', sa.Text, nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False,
+                  server_default=sa.func.now()),
+        sa.UniqueConstraint('path', 'key', name='uniq_idempotency_key'),
+    )
+
+
+def downgrade():
+    op.drop_table('idempotency_key')
@@ -0,0 +1,37 @@
+"""wallet ledger
+
+Revision ID: d3a6f1c8e240
+Revises: b95e1c47d2a8
+Create Date: 2026-10-18 21:12:46.305718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a6f1c8e240'
+down_revision = 'b95e1c47d2a8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # current amounts become compacted balances with no entries after them
+    op.add_column('wallet', sa.Column('entry_id', sa.Integer, nullable=False, server_default='0'))
+    op.create_table(
+        'wallet_entry',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('delta', sa.Numeric(precision=20, scale=3), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False,
+                  server_default=sa.func.now()),
+        sa.Column('wallet_id', sa.Integer, sa.ForeignKey('wallet.id'), nullable=False),
+        sa.Column('transaction_id', sa.Integer, sa.ForeignKey('transaction.id'), nullable=True),
+    )
+    op.create_index('ix_wallet_entry_wallet_id_id', 'wallet_entry', ['wallet_id', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_wallet_entry_wallet_id_id', 'wallet_entry')
+    op.drop_table('wallet_entry')
+    op.drop_column('wallet', 'entry_id')
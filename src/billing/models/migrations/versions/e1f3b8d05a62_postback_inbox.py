@@ -0,0 +1,44 @@
+"""postback inbox
+
+Revision ID: e1f3b8d05a62
+Revises: a4d7c2e9b150
+Create Date: 2026-10-18 18:05:33.871420
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f3b8d05a62'
+down_revision = 'a4d7c2e9b150'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'postback',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('payload', sa.Text, nullable=False),
+        sa.Column('status', sa.Enum(
+            'pending', 'applied', 'skipped', 'failed', name='postbackstatus'
+        ), nullable=False, server_default='pending'),
+        sa.Column('error', sa.Text, nullable=False, server_default=''),
+        sa.Column('received_at', sa.DateTime(timezone=True), nullable=False,
+                  server_default=sa.func.now()),
+        sa.Column('processed_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('attempt_id', sa.Integer, nullable=False),
+        sa.Column('payment_system_id', sa.Integer, sa.ForeignKey('payment_system.id'),
+                  nullable=False),
+    )
+    # queue is scanned & counted by pending rows only
+    op.create_index(
+        'ix_postback_pending', 'postback', ['id'], postgresql_where=sa.text("status = 'pending'")
+    )
+
+
+def downgrade():
+    op.drop_index('ix_postback_pending', 'postback')
+    op.drop_table('postback')
+    op.execute('DROP TYPE postbackstatus')
@@ -17,6 +17,31 @@ DATABASES = {
     'test': {
         'driver': SYNC_DRIVER,
         'url': f'{SYNC_DRIVER}:{TEST_DATABASE_URL}',
+    },
+    'test_async': {
+        'driver': ASYNC_DRIVER,
+        'url': f'{ASYNC_DRIVER}:{TEST_DATABASE_URL}',
+    }
+}
+ECHO_SQL = environ.get('ECHO_SQL', '') == '1'
+
+
+def pool_settings(name: str, size: int, max_overflow: int) -> dict:
+    prefix = f'DATABASE_{name.upper()}_POOL_'
+    return {
+        'pool_size': int(environ.get(f'{prefix}SIZE', size)),
+        'max_overflow': int(environ.get(f'{prefix}MAX_OVERFLOW', max_overflow)),
+        # seconds to wait for free connection before TimeoutError
+        'pool_timeout': float(environ.get(f'{prefix}TIMEOUT', 30)),
+        # seconds, -1 to keep connections forever
+        'pool_recycle': int(environ.get(f'{prefix}RECYCLE', 1800)),
+        'pool_pre_ping': environ.get(f'{prefix}PRE_PING', '1') == '1',
     }
+
+
+# serializable manager transactions get their own pool,
+# so they don't starve read-only views and vice versa
+POOLS = {
+    'read': pool_settings('read', size=5, max_overflow=10),
+    'write': pool_settings('write', size=5, max_overflow=5),
 }
-ECHO_SQL = True
@@ -1,21 +1,38 @@
 from typing import Optional
-from uuid import uuid4, UUID
+from uuid import uuid4
+from datetime import datetime, timezone
 
 from sqlmodel import Field, SQLModel, Relationship, Column, Enum, String, Text
-from pydantic import condecimal
+from sqlalchemy import Index, DateTime, UniqueConstraint, func, text
 
+from money import Amount
 from .wallets import Wallet
 from .choices import InvoiceStatus, TransactionStatus, AttemptStatus,\
-    PaymentSystemType, TransactionType
+    PaymentSystemType, TransactionType, PostbackStatus
+
+
+def new_token() -> str:
+    # column is a plain string, asyncpg doesn't adapt UUID to it
+    return str(uuid4())
+
+
+def now() -> datetime:
+    return datetime.now(timezone.utc)
 
 
 class Invoice(SQLModel, table=True):
     __tablename__ = 'invoice'
+    __table_args__ = (
+        Index('uniq_invoice_token', 'token', unique=True),
+        Index('ix_invoice_to_wallet_id', 'to_wallet_id'),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     # token is exposed to user
-    token: UUID = Field(default_factory=uuid4, index=True, sa_column=Column(String(36)))
-    amount: condecimal(max_digits=20, decimal_places=3)
+    token: str = Field(default_factory=new_token, index=True, sa_column=Column(String(36)))
+    amount: Amount
+    # sum of successful transactions' effective amounts, kept by managers
+    paid_amount: Amount = Field(default=0)
     status: str = Field(sa_column=Column(Enum(InvoiceStatus)), default=TransactionStatus.pending)
 
     to_wallet_id: int = Field(default=None, nullable=False, foreign_key='wallet.id')
@@ -28,11 +45,27 @@ class PaymentSystem(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(sa_column=Column(String(36)))
     system_type: str = Field(sa_column=Column(Enum(PaymentSystemType)))
+    # comma separated fernet keys: the first is primary, the rest are accepted while rotating
     decryption_key: str = Field(sa_column=Column(String(1024)))
 
 
+class PaymentSystemVersion(SQLModel, table=True):
+    '''
+    Single row bumped by db trigger on any payment system change
+    '''
+    __tablename__ = 'payment_system_version'
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    version: int = Field(default=0)
+
+
 class Transaction(SQLModel, table=True):
     __tablename__ = 'transaction'
+    __table_args__ = (
+        Index('uniq_transaction_token', 'token', unique=True),
+        Index('ix_transaction_invoice_id_status', 'invoice_id', 'status'),
+        Index('ix_transaction_created_at', 'created_at'),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     transaction_type = Field(
@@ -40,11 +73,15 @@ class Transaction(SQLModel, table=True):
         default=TransactionType.external
     )
     # token is exposed to user
-    token: UUID = Field(default_factory=uuid4, index=True, sa_column=Column(String(36)))
-    amount: condecimal(max_digits=20, decimal_places=3)
+    token: str = Field(default_factory=new_token, index=True, sa_column=Column(String(36)))
+    amount: Amount
     # equivaltent amount in invoice's currency
-    effective_amount: condecimal(max_digits=20, decimal_places=3)
+    effective_amount: Amount
     status: str = Field(sa_column=Column(Enum(TransactionStatus)), default=TransactionStatus.pending)
+    created_at: datetime = Field(
+        default_factory=now,
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
 
     invoice_id: int = Field(default=None, nullable=False, foreign_key='invoice.id')
     invoice: Invoice = Relationship()
@@ -53,12 +90,40 @@ class Transaction(SQLModel, table=True):
     from_wallet: Wallet = Relationship()
 
 
+class WalletEntry(SQLModel, table=True):
+    '''
+    Append-only wallet ledger, balance is wallet's amount plus entries after its entry_id
+    '''
+    __tablename__ = 'wallet_entry'
+    __table_args__ = (
+        Index('ix_wallet_entry_wallet_id_id', 'wallet_id', 'id'),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # signed, debits are negative
+    delta: Amount
+    created_at: datetime = Field(
+        default_factory=now,
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
+
+    wallet_id: int = Field(default=None, nullable=False, foreign_key='wallet.id')
+    transaction_id: Optional[int] = Field(
+        default=None, nullable=True, foreign_key='transaction.id'
+    )
+    transaction: Optional[Transaction] = Relationship()
+
+
 class Attempt(SQLModel, table=True):
     __tablename__ = 'attempt'
+    __table_args__ = (
+        Index('uniq_attempt_token', 'token', unique=True),
+        Index('ix_attempt_transaction_id', 'transaction_id'),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     # token is exposed to user
-    token: UUID = Field(default_factory=uuid4, index=True, sa_column=Column(String(36)))
+    token: str = Field(default_factory=new_token, index=True, sa_column=Column(String(36)))
     # b64 encoded decrypted response
     response: str = Field(sa_column=Column(Text), default='')
     status: str = Field(sa_column=Column(Enum(AttemptStatus)), default=AttemptStatus.pending)
@@ -68,3 +133,46 @@ class Attempt(SQLModel, table=True):
 
     payment_system_id: int = Field(default=None, nullable=False, foreign_key='payment_system.id')
     payment_system: PaymentSystem = Relationship()
+
+
+class Postback(SQLModel, table=True):
+    '''payment system response, verified & stored as is until worker applies it'''
+    __tablename__ = 'postback'
+    __table_args__ = (
+        Index('ix_postback_pending', 'id', postgresql_where=text("status = 'pending'")),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    # encrypted payload
+    payload: str = Field(sa_column=Column(Text, nullable=False))
+    status: str = Field(sa_column=Column(Enum(PostbackStatus)), default=PostbackStatus.pending)
+    error: str = Field(sa_column=Column(Text), default='')
+    received_at: datetime = Field(
+        default_factory=now,
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
+    processed_at: Optional[datetime] = Field(
+        sa_column=Column(DateTime(timezone=True), nullable=True)
+    )
+
+    # not a foreign key, unknown attempts are reported by worker, not at ingestion
+    attempt_id: int = Field(default=None, nullable=False)
+    payment_system_id: int = Field(default=None, nullable=False, foreign_key='payment_system.id')
+
+
+class IdempotencyKey(SQLModel, table=True):
+    '''response of payment creating request, replayed for requests with same key'''
+    __tablename__ = 'idempotency_key'
+    __table_args__ = (UniqueConstraint('path', 'key', name='uniq_idempotency_key'),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    key: str = Field(sa_column=Column(String(255), nullable=False))
+    path: str = Field(sa_column=Column(String(255), nullable=False))
+    # sha256 of request, same key can't be reused for different request
+    request_hash: str = Field(sa_column=Column(String(64), nullable=False))
+    # json, set along with commit, so committed rows always have it
+    response: Optional[str] = Field(sa_column=Column(Text, nullable=True))
+    created_at: datetime = Field(
+        default_factory=now,
+        sa_column=Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    )
@@ -1,9 +1,9 @@
 from typing import Optional
 
 from sqlmodel import Field, SQLModel, Relationship
-from pydantic import condecimal
 from sqlalchemy import UniqueConstraint, Column, Enum
 
+from money import Amount
 from .accounts import Merchant
 from .choices import CurrencyCode
 
@@ -21,7 +21,9 @@ class Wallet(SQLModel, table=True):
     __table_args__ = (UniqueConstraint('merchant_id', 'currency_id', name='uniq_wallet'),)
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    amount: condecimal(max_digits=20, decimal_places=3) = Field(default=0)
+    # balance compacted from ledger entries up to entry_id, see services.wallet_balances
+    amount: Amount = Field(default=0)
+    entry_id: int = Field(default=0, nullable=False)
 
     merchant_id: int = Field(default=None, nullable=False, foreign_key='merchant.id')
     merchant: Merchant = Relationship()
@@ -35,7 +37,7 @@ class ConversionRate(SQLModel, table=True):
     __table_args__ = (UniqueConstraint('from_currency_id', 'to_currency_id', name='uniq_conv_rate'),)
 
     id: Optional[int] = Field(default=None, primary_key=True)
-    rate: condecimal(max_digits=20, decimal_places=3)  # for simplicity same as amount
+    rate: Amount  # for simplicity same as amount
     allow_reversed: bool  # allows backward conversion with reversed rate
 
     from_currency_id: int = Field(default=None, nullable=False, foreign_key='currency.id')
@@ -47,3 +49,13 @@ class ConversionRate(SQLModel, table=True):
     to_currency: Currency = Relationship(sa_relationship_kwargs={
         'foreign_keys': 'ConversionRate.to_currency_id'
     })
+
+
+class ConversionRateVersion(SQLModel, table=True):
+    '''
+    Single row bumped by db trigger on any currency or conversion rate change
+    '''
+    __tablename__ = 'conversion_rate_version'
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    version: int = Field(default=0)
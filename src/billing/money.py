@@ -0,0 +1,64 @@
+from decimal import Decimal, Context, InvalidOperation, DivisionByZero, Overflow,\
+    ROUND_HALF_UP, ROUND_DOWN, ROUND_UP
+
+from pydantic import condecimal
+
+
+'''
+    amounts are stored as numeric(20, 3), values computed in python are
+    rounded the same way before they are compared, summed or stored,
+    so they are exactly what db keeps
+'''
+
+
+MAX_DIGITS = 20
+DECIMAL_PLACES = 3
+QUANTUM = Decimal(1).scaleb(-DECIMAL_PLACES)
+
+# independent of thread's current context, intermediate results (e.g. amount / rate)
+# keep enough digits to be rounded only once
+CONTEXT = Context(
+    prec=34, rounding=ROUND_HALF_UP, traps=[InvalidOperation, DivisionByZero, Overflow]
+)
+
+# model field type of amount columns
+Amount = condecimal(max_digits=MAX_DIGITS, decimal_places=DECIMAL_PLACES)
+
+
+def quantize(value: Decimal, rounding: str = ROUND_HALF_UP) -> Decimal:
+    '''
+    Rounds to stored precision. Default rounding is postgres' one
+    for numeric columns (half away from zero)
+    '''
+    result = value.quantize(QUANTUM, rounding=rounding, context=CONTEXT)
+    if result.adjusted() >= MAX_DIGITS - DECIMAL_PLACES:
+        raise InvalidOperation(f'{value} has more than {MAX_DIGITS} digits')
+    return result
+
+
+def parse(value) -> Decimal:
+    '''amount from request, raises InvalidOperation if it's not a finite number'''
+    amount = CONTEXT.create_decimal(str(value).strip())
+    if not amount.is_finite():
+        raise InvalidOperation(f'{value} is not a finite number')
+    return quantize(amount)
+
+
+def convert(amount: Decimal, rate: Decimal) -> Decimal:
+    '''
+    Amount paid in other currency to amount credited in invoice's one (amount / rate),
+    rounded down, so invoice is never credited more than was paid
+    '''
+    return quantize(CONTEXT.divide(amount, rate), ROUND_DOWN)
+
+
+def convert_back(effective_amount: Decimal, rate: Decimal) -> Decimal:
+    '''
+    Amount to credit in invoice's currency to amount charged in other one
+    (effective amount * rate), rounded up, so payer is never charged less
+    '''
+    return quantize(CONTEXT.multiply(effective_amount, rate), ROUND_UP)
+
+
+def reverse_rate(rate: Decimal) -> Decimal:
+    return CONTEXT.divide(1, rate)
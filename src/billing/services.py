@@ -1,24 +1,35 @@
 import json
-from uuid import uuid4
-from typing import Optional, Union
-from decimal import Decimal
+import random
+import asyncio
+import logging
+from time import monotonic
+from typing import Optional, Union, AsyncIterator
+from decimal import Decimal, InvalidOperation
+from functools import wraps
+from threading import Lock
 from contextvars import ContextVar
 
 import networkx as nx
-from networkx.algorithms.shortest_paths.generic import shortest_path
-from networkx.algorithms.shortest_paths.weighted import\
-    single_source_dijkstra_path
-from cachetools.func import ttl_cache
-from cryptography.fernet import Fernet
-
-from models.core import session, serializable_session
-from models.wallets import Wallet, Currency, ConversionRate
-from models.transactions import PaymentSystem, Invoice, Transaction, Attempt
+from anyio import to_thread
+from cryptography.fernet import Fernet, MultiFernet
+from sqlalchemy import select, insert, update, func, case, cast, and_
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError, NoResultFound
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from settings.core import RATES_POLL_INTERVAL, PAYMENT_SYSTEMS_POLL_INTERVAL, MANAGER_RETRIES,\
+    MANAGER_RETRY_BACKOFF
+import money
+from metrics import registry
+from models.core import session, serializable_session, async_session,\
+    async_serializable_session, get_request_session
+from models.wallets import Wallet, Currency, ConversionRate, ConversionRateVersion
+from models.transactions import PaymentSystem, PaymentSystemVersion, Invoice, Transaction,\
+    Attempt, Postback, WalletEntry, new_token, now
 from models.choices import InvoiceStatus, TransactionStatus, AttemptStatus,\
-    PaymentSystemType, TransactionType
+    PaymentSystemType, TransactionType, PostbackStatus
 
 
-DAY: int = 60 * 60 * 24
+logger = logging.getLogger(__name__)
 
 
 '''
@@ -45,89 +56,320 @@ DAY: int = 60 * 60 * 24
 '''
 
 
-@ttl_cache(maxsize=None, ttl=DAY)
+class ConversionMatrix:
+    '''
+    Dense all-pairs table of conversion rates built from rates graph.
+    Cheapest paths are found once with Floyd-Warshall (same edge weights
+    `shortest_path` used), rates along each path are multiplied once,
+    so lookup is a plain indexed read
+    '''
+
+    def __init__(self, G: nx.DiGraph):
+        self.index = {node: i for i, node in enumerate(G.nodes)}
+        nodes = list(self.index)
+        size = len(nodes)
+
+        dist = [[None] * size for _ in range(size)]
+        succ = [[None] * size for _ in range(size)]
+        for i in range(size):
+            dist[i][i] = Decimal('0')
+            succ[i][i] = i
+        for left, right, weight in G.edges.data('weight'):
+            i, j = self.index[left], self.index[right]
+            if i != j:
+                dist[i][j] = weight
+                succ[i][j] = j
+
+        for k in range(size):
+            dist_k = dist[k]
+            for i in range(size):
+                if (dist_ik := dist[i][k]) is None:
+                    continue
+                dist_i, succ_i = dist[i], succ[i]
+                for j in range(size):
+                    if (dist_kj := dist_k[j]) is None:
+                        continue
+                    if dist_i[j] is None or dist_ik + dist_kj < dist_i[j]:
+                        dist_i[j] = dist_ik + dist_kj
+                        succ_i[j] = succ_i[k]
+
+        self.rates = [[None] * size for _ in range(size)]
+        self.paths = [[None] * size for _ in range(size)]
+        for i in range(size):
+            for j in range(size):
+                if succ[i][j] is None:
+                    continue
+                path, rate, node = [i], Decimal('1'), i
+                while node != j:
+                    step = succ[node][j]
+                    rate = money.CONTEXT.multiply(
+                        rate, G.get_edge_data(nodes[node], nodes[step])['weight']
+                    )
+                    path.append(node := step)
+                self.rates[i][j] = rate
+                self.paths[i][j] = tuple(nodes[n] for n in path)
+
+        # rates of every currency converted into given one, as /rates/ returns them
+        self.rates_table = {
+            to: {
+                from_: self.rates[i][j]
+                for i, from_ in enumerate(nodes)
+                if self.rates[i][j] is not None
+            }
+            for j, to in enumerate(nodes)
+        }
+
+    def rate(self, from_: int, to: int) -> Optional[Decimal]:
+        try:
+            return self.rates[self.index[from_]][self.index[to]]
+        except KeyError:
+            return
+
+    def path(self, from_: int, to: int) -> Optional[tuple[int, ...]]:
+        try:
+            return self.paths[self.index[from_]][self.index[to]]
+        except KeyError:
+            return
+
+
 def calculate_conv_rate(from_: int, to: int) -> Optional[Decimal]:
     if from_ == to:
         return Decimal('1')
 
-    G = get_conversion_rate_graph()
+    return get_conversion_matrix().rate(from_, to)
 
-    try:
-        path = shortest_path(G, from_, to, weight='weight')
-    except (nx.NodeNotFound, nx.NetworkXNoPath):
-        return
 
-    rate = Decimal('1')
-    for left, right in zip(path, path[1:]):
-        rate *= G.get_edge_data(left, right)['weight']
+def get_conversion_matrix() -> ConversionMatrix:
+    _, _, matrix = conversion_rate_graph.current()
+    return matrix
 
-    return rate
 
+class VersionedCache:
+    '''
+    Keeps data loaded for the latest seen version of `version_model` row.
+    Version row is bumped by db trigger on every change of the data,
+    it's polled at most once per `poll_interval` seconds and snapshot
+    is reloaded only when version differs. While one thread reloads snapshot
+    others keep using previous one, new snapshot replaces it in single assignment
+    '''
+    version_model = None
 
-def get_conversion_rate_graph(fresh: bool = False) -> nx.DiGraph:
-    if fresh:
-        return _get_conversion_rate_graph(uuid4())
-    return _get_conversion_rate_graph()
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self.snapshot = None  # (version, *loaded)
+        self.polled_at = float('-inf')
+        self.lock = Lock()
+        # set while manager operation runs on event loop, see BaseManager.run
+        self.pinned = ContextVar(f'pinned_{type(self).__name__}', default=None)
 
+    def load(self, s) -> tuple:
+        raise NotImplementedError
 
-def get_reversed_conversion_rate_graph(fresh: bool = False) -> nx.DiGraph:
-    G = get_conversion_rate_graph(fresh=fresh)
-    RG = nx.DiGraph()
-    RG.add_nodes_from(G.nodes)
-    for left, right in G.edges:
-        rate = G.get_edge_data(left, right)['weight']
-        RG.add_edge(right, left, weight=rate)
-    return RG
+    def get(self) -> tuple:
+        snapshot = self.snapshot
+        if snapshot is not None and monotonic() - self.polled_at < self.poll_interval:
+            return snapshot
 
+        if not self.lock.acquire(blocking=snapshot is None):
+            return snapshot
 
-@ttl_cache(maxsize=1, ttl=DAY)
-def _get_conversion_rate_graph(_: Optional[str] = None) -> nx.DiGraph:
+        try:
+            with session() as s:
+                version = s.query(self.version_model.version).scalar()
+                if self.snapshot is None or self.snapshot[0] != version:
+                    self.snapshot = (version, *self.load(s))
+        except SQLAlchemyError:
+            if self.snapshot is None:
+                raise
+            logger.exception(
+                'failed to poll %s, keep using version %s', self.version_model.__name__, snapshot[0]
+            )
+        finally:
+            # failed poll is retried on next interval too, not on every call
+            self.polled_at = monotonic()
+            self.lock.release()
+
+        return self.snapshot
+
+    async def async_get(self) -> tuple:
+        snapshot = self.snapshot
+        if snapshot is not None and monotonic() - self.polled_at < self.poll_interval:
+            return snapshot
+        # polling and reloading are blocking, keep them off event loop
+        return await to_thread.run_sync(self.get)
+
+    def current(self) -> tuple:
+        '''snapshot pinned for running operation, or the latest one'''
+        if (snapshot := self.pinned.get()) is not None:
+            return snapshot
+        return self.get()
+
+
+class ConversionRateGraphCache(VersionedCache):
+    '''Rates graph and conversion matrix, version is bumped on currency/conversion rate change'''
+    version_model = ConversionRateVersion
+
+    def load(self, s) -> tuple[nx.DiGraph, ConversionMatrix]:
+        G = _get_conversion_rate_graph(s)
+        return G, ConversionMatrix(G)
+
+
+conversion_rate_graph = ConversionRateGraphCache(poll_interval=RATES_POLL_INTERVAL)
+
+
+def get_conversion_rate_graph() -> nx.DiGraph:
+    _, G, _ = conversion_rate_graph.get()
+    return G
+
+
+def _get_conversion_rate_graph(s) -> nx.DiGraph:
     G = nx.DiGraph()
 
-    with session() as s:
-        G.add_nodes_from([i for i, in s.query(Currency.id).all()])
+    G.add_nodes_from([i for i, in s.query(Currency.id).all()])
 
-        for cr in s.query(ConversionRate).all():
-            G.add_edge(cr.from_currency_id, cr.to_currency_id, weight=cr.rate)
-            if cr.allow_reversed:
-                G.add_edge(
-                    cr.to_currency_id, cr.from_currency_id,
-                    weight=Decimal('1') / cr.rate
-                )
+    for cr in s.query(ConversionRate).all():
+        G.add_edge(cr.from_currency_id, cr.to_currency_id, weight=cr.rate)
+        if cr.allow_reversed:
+            G.add_edge(
+                cr.to_currency_id, cr.from_currency_id,
+                weight=money.reverse_rate(cr.rate)
+            )
 
     return G
 
 
-@ttl_cache(maxsize=1, ttl=DAY)
-def calculate_rates(from_currency_id: int):
-    RG = get_reversed_conversion_rate_graph()
-    paths = single_source_dijkstra_path(RG, from_currency_id)
+def calculate_rates(from_currency_id: int) -> dict[int, Decimal]:
+    # whole table is built along with matrix, so any currency is a dict lookup
+    rates = get_conversion_matrix().rates_table.get(from_currency_id, {})
+    return dict(rates)
+
+
+async def async_calculate_rates(from_currency_id: int) -> dict[int, Decimal]:
+    _, _, matrix = await conversion_rate_graph.async_get()
+    return dict(matrix.rates_table.get(from_currency_id, {}))
 
-    for k, v in paths.copy().items():
-        rate = Decimal('1')
-        path = paths[k]
 
-        for left, right in zip(path, path[1:]):
-            rate *= RG.get_edge_data(left, right)['weight']
+# invoices inserted by one statement, 5 parameters each
+INVOICE_BATCH_SIZE = 1000
+# postbacks claimed by worker at once
+POSTBACK_BATCH_SIZE = 100
+WALLET_COMPACTION_BATCH_SIZE = 100
 
-        paths[k] = rate
 
-    return paths
+def parse_invoice(item) -> tuple[Decimal, int]:
+    try:
+        amount, wallet_id = money.parse(item['amount']), int(item['to_wallet_id'])
+    except (TypeError, KeyError, ValueError, InvalidOperation):
+        raise ValueError('amount and to_wallet_id are required')
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError('amount must be positive')
+    return amount, wallet_id
+
+
+async def create_invoices(
+        session: AsyncSession, merchant_id: int, items: list
+) -> AsyncIterator[dict]:
+    '''
+    Creates invoices for merchant's wallets, batch by batch: wallets are checked
+    with one query and invoices are inserted with one multi row insert per batch.
+    Yields result of every item in order, {'token': ...} or {'error': ...}
+    '''
+    for start in range(0, len(items), INVOICE_BATCH_SIZE):
+        parsed = []
+        for item in items[start:start + INVOICE_BATCH_SIZE]:
+            try:
+                parsed.append(parse_invoice(item))
+            except ValueError as e:
+                parsed.append(str(e))
+
+        wallet_ids = {p[1] for p in parsed if isinstance(p, tuple)}
+        owned = set((await session.execute(
+            select(Wallet.id)
+            .filter(Wallet.merchant_id == merchant_id)
+            .filter(Wallet.id.in_(wallet_ids))
+        )).scalars()) if wallet_ids else set()
+
+        rows, results = [], []
+        for p in parsed:
+            if isinstance(p, str):
+                results.append({'error': p})
+            elif p[1] not in owned:
+                results.append({'error': 'wallet not found'})
+            else:
+                # tokens are generated here, so results keep order without RETURNING
+                rows.append({
+                    'token': (token := new_token()), 'amount': p[0],
+                    'to_wallet_id': p[1], 'status': InvoiceStatus.pending
+                })
+                results.append({'token': token})
+
+        if rows:
+            await session.execute(insert(Invoice).values(rows))
+            await session.commit()
+
+        for result in results:
+            yield result
+
+
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+
+
+def is_conflict(error: DBAPIError) -> bool:
+    return getattr(error.orig, 'pgcode', None) in (SERIALIZATION_FAILURE, DEADLOCK_DETECTED)
+
+
+READ_COMMITTED = 'READ COMMITTED'
+REPEATABLE_READ = 'REPEATABLE READ'
+SERIALIZABLE = 'SERIALIZABLE'
+
+
+def operation(isolation_level: str = SERIALIZABLE, lock: bool = True):
+    '''
+    Declares isolation level manager operation needs and whether it locks fetched rows.
+    Level is applied by `run` when operation starts a transaction, read only operations
+    shouldn't wait for payments in flight
+    '''
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            previous, self.lock = self.lock, lock
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.lock = previous
+        wrapper.isolation_level = isolation_level
+        return wrapper
+    return decorator
 
 
 # to safely nest managers
 manager_session = ContextVar('manager_session')
+async_manager_session = ContextVar('async_manager_session')
 
 
 class BaseManager:
     '''
     Managers works as a service classes to invoices, payments & payment attempts
     They designed to be used as context managers. Main operations lock selected rows.
+
+    Inside `async with` operations should be called through `run`: they are executed
+    over async connection (same code, sync session is proxied by sqlalchemy greenlets),
+    so db io doesn't block event loop and doesn't occupy threadpool.
+    Operations run that way must not do other blocking io or heavy cpu work.
+    Serialization failures & deadlocks are retried (whole operation from scratch,
+    so operations must start with fetch), up to MANAGER_RETRIES times.
+    Entered inside request unit of work, they run on request's connection
+    instead of checking out another one
     '''
 
     def __init__(self):
+        self.lock = True
         self.session = None
         self._token = None
+        self.async_session = None
+        self._async_token = None
+        self._closes_session = False
 
     def __enter__(self):
         try:
@@ -141,12 +383,110 @@ class BaseManager:
 
     def __exit__(self, *args):
         if self._token:
+            manager_session.reset(self._token)
             return self.session.__exit__(*args)
 
+    async def __aenter__(self):
+        try:
+            self.async_session = async_manager_session.get()
+        except LookupError:
+            if (session := get_request_session()) is None or session.in_transaction():
+                # transaction held open by request (e.g. idempotency key) isn't ours
+                session = async_serializable_session()
+                await session.__aenter__()
+                self._closes_session = True
+            self.async_session = session
+            self._async_token = async_manager_session.set(session)
+        self.session = self.async_session.sync_session
+        return self
+
+    async def __aexit__(self, *args):
+        if not self._async_token:
+            return
+        async_manager_session.reset(self._async_token)
+        if self._closes_session:
+            return await self.async_session.__aexit__(*args)
+        # request session is left as closing would leave own one: objects detached,
+        # transaction ended, connection back at its default isolation level
+        self.async_session.expunge_all()
+        await self.async_session.rollback()
+        connection = self.async_session.bind
+        await connection.execution_options(isolation_level=connection.default_isolation_level)
+
+    def for_update(self, query, **kwargs):
+        return query.with_for_update(**kwargs) if self.lock else query
+
+    @staticmethod
+    def by_id_or_token(model, id: Optional[int], token: Optional[str]):
+        # views pass public token, so row is resolved & locked by the fetch itself
+        return model.id == id if token is None else model.token == token
+
+    async def run(self, method, *args, **kwargs):
+        # rates & payment systems are refreshed in threadpool beforehand,
+        # operation only reads them
+        caches = (conversion_rate_graph, payment_systems)
+        snapshots = [await cache.async_get() for cache in caches]
+
+        def call(session):
+            # managers nested in method reuse same session
+            token = manager_session.set(session)
+            pinned = [cache.pinned.set(s) for cache, s in zip(caches, snapshots)]
+            try:
+                return method(*args, **kwargs)
+            finally:
+                for cache, cache_token in zip(caches, pinned):
+                    cache.pinned.reset(cache_token)
+                manager_session.reset(token)
+
+        if not self._async_token:
+            # nested manager, conflict is retried by the one owning session
+            return await self.async_session.run_sync(call)
+
+        # level is set by transaction starting operation, request connection
+        # defaults to read committed
+        isolation_level = getattr(method, 'isolation_level', SERIALIZABLE)
+        for retry in range(MANAGER_RETRIES + 1):
+            try:
+                begins = not self.async_session.in_transaction()
+                if begins:
+                    await self.async_session.connection(
+                        execution_options={'isolation_level': isolation_level}
+                    )
+                result = await self.async_session.run_sync(call)
+                if begins and isolation_level != SERIALIZABLE:
+                    # following operations of this manager mustn't run in it
+                    await self.async_session.commit()
+                return result
+            except DBAPIError as e:
+                if not is_conflict(e):
+                    raise
+                registry.counter('db.conflicts').inc()
+                await self.async_session.rollback()
+                if retry == MANAGER_RETRIES:
+                    registry.counter('db.conflicts.unresolved').inc()
+                    raise
+            registry.counter('db.retries').inc()
+            # full jitter, so conflicting requests don't collide again
+            await asyncio.sleep(random.uniform(0, MANAGER_RETRY_BACKOFF * 2 ** retry))
+
+
+def wallet_balances(wallet_ids: list[int]):
+    '''
+    (wallet id, balance) rows: compacted amount plus ledger entries appended after it,
+    those are read by (wallet_id, id) index, compaction keeps their number small
+    '''
+    return select(Wallet.id, Wallet.amount + func.coalesce(func.sum(WalletEntry.delta), 0))\
+        .outerjoin(WalletEntry, and_(
+            WalletEntry.wallet_id == Wallet.id, WalletEntry.id > Wallet.entry_id
+        ))\
+        .filter(Wallet.id.in_(wallet_ids))\
+        .group_by(Wallet.id)
+
 
 class InvoiceManager(BaseManager):
-    def __init__(self, invoice_id: int):
+    def __init__(self, invoice_id: Optional[int] = None, *, token: Optional[str] = None):
         self.invoice_id = invoice_id
+        self.token = token
         self.wallet = None
         self.invoice = None
         self.paid_amount = None
@@ -154,19 +494,15 @@ class InvoiceManager(BaseManager):
         super().__init__()
 
     def fetch(self):
-        self.wallet, self.invoice =\
-            self.session.query(Wallet, Invoice)\
-                        .filter(Wallet.id == Invoice.to_wallet_id)\
-                        .filter(Invoice.id == self.invoice_id)\
-                        .with_for_update()\
-                        .one()
-        paid_transactions =\
-            self.session.query(Transaction)\
-                        .filter(Transaction.invoice_id == self.invoice_id)\
-                        .filter(Transaction.status == TransactionStatus.success)\
-                        .with_for_update()\
-                        .all()
-        self.paid_amount = sum(t.effective_amount for t in paid_transactions)
+        # receiving wallet isn't locked, it's credited by appending ledger entries
+        self.wallet, self.invoice = self.for_update(
+            self.session.query(Wallet, Invoice)
+                        .filter(Wallet.id == Invoice.to_wallet_id)
+                        .filter(self.by_id_or_token(Invoice, self.invoice_id, self.token)),
+            of=Invoice
+        ).one()
+        self.invoice_id = self.invoice.id
+        self.paid_amount = self.invoice.paid_amount
         self.unpaid_amount = self.invoice.amount - self.paid_amount
 
     def create_transaction(
@@ -205,11 +541,16 @@ class InvoiceManager(BaseManager):
             effective_amount: Optional[Decimal] = None
     ):
         self.fetch()
-        from_wallet = self.session.query(Wallet)\
-                                  .filter(Wallet.merchant_id == merchant_id)\
-                                  .filter(Wallet.id == wallet_id)\
-                                  .with_for_update()\
-                                  .one()
+        # both wallets are locked by one statement in id order, after invoice, so payments
+        # between two merchants can't lock them in opposite orders. Key share locks don't
+        # block credits to the wallets, concurrent debits of one wallet are serializable
+        # conflict on its ledger entries and retried
+        wallets = {wallet.id: wallet for wallet in self.session.query(Wallet).filter(
+            Wallet.id.in_((wallet_id, self.wallet.id))
+        ).order_by(Wallet.id).with_for_update(read=True, key_share=True)}
+        from_wallet = wallets.get(wallet_id)
+        if from_wallet is None or from_wallet.merchant_id != merchant_id:
+            raise NoResultFound('wallet not found')
 
         if not (rate := calculate_conv_rate(from_wallet.currency_id, self.wallet.currency_id)):
             return None
@@ -225,49 +566,49 @@ class InvoiceManager(BaseManager):
             invoice_id=self.invoice.id,
             from_wallet_id=from_wallet.id,
             transaction_type=TransactionType.internal,
-            status=TransactionStatus.pending
+            status=TransactionStatus.fail
         )
         # sometimes passing amount in constructor don't work
         transaction.amount = amount
         transaction.effective_amount = effective_amount
         self.invoice.status = InvoiceStatus.incomplete
-        self.session.add(self.invoice)
-        self.session.commit()
 
-        try:
-            if from_wallet.amount >= amount:
-                from_wallet.amount -= amount
-                self.wallet.amount += effective_amount
-                transaction.status = TransactionStatus.success
-                if effective_amount >= self.unpaid_amount:
-                    self.invoice.status = InvoiceStatus.complete
-                self.session.add_all((self.invoice, from_wallet, self.wallet, transaction))
-                self.session.commit()
-            else:
-                transaction.status = TransactionStatus.fail
-                self.session.add(transaction)
-                self.session.commit()
-        except:  # noqa
-            transaction.status = TransactionStatus.fail
-            self.session.add(transaction)
-            self.session.commit()
+        _, balance = self.session.execute(wallet_balances([from_wallet.id])).one()
+        if balance >= amount:
+            self.session.add_all((
+                WalletEntry(wallet_id=from_wallet.id, delta=-amount, transaction=transaction),
+                WalletEntry(wallet_id=self.wallet.id, delta=effective_amount,
+                            transaction=transaction),
+            ))
+            transaction.status = TransactionStatus.success
+            self.invoice.paid_amount += effective_amount
+            if effective_amount >= self.unpaid_amount:
+                self.invoice.status = InvoiceStatus.complete
+
+        # single commit, locks are held till transaction is recorded with its outcome
+        self.session.add_all((self.invoice, transaction))
+        self.session.commit()
 
         return transaction
 
     def calculate_amounts(self, amount, effective_amount, rate):
+        # both amounts are rounded as stored, so they are compared & summed exactly
         if amount is not None:
-            effective_amount = amount / rate
+            amount = money.quantize(amount)
+            effective_amount = money.convert(amount, rate)
             if effective_amount > self.unpaid_amount:
                 return None
             return (amount, effective_amount)
         elif effective_amount is not None:
-            amount = effective_amount * rate
+            effective_amount = money.quantize(effective_amount)
+            amount = money.convert_back(effective_amount, rate)
             if effective_amount > self.unpaid_amount:
                 return None
             return (amount, effective_amount)
         else:
             return None
 
+    @operation(READ_COMMITTED, lock=False)
     def get_payment_info(self):
         self.fetch()
         return {
@@ -280,8 +621,9 @@ class InvoiceManager(BaseManager):
 
 
 class TransactionManager(BaseManager):
-    def __init__(self, transaction_id: int):
+    def __init__(self, transaction_id: Optional[int] = None, *, token: Optional[str] = None):
         self.transaction_id = transaction_id
+        self.token = token
         self.transaction = None
         self.invoice = None
         super().__init__()
@@ -289,7 +631,7 @@ class TransactionManager(BaseManager):
     def fetch(self, paid=None, complete=None):
         # just lock
         queryset = self.session.query(Transaction, Invoice)\
-                               .filter(Transaction.id == self.transaction_id)\
+                               .filter(self.by_id_or_token(Transaction, self.transaction_id, self.token))\
                                .filter(Invoice.id == Transaction.invoice_id)
         if paid is True:
             queryset = queryset.filter(Transaction.status == TransactionStatus.success)
@@ -301,7 +643,8 @@ class TransactionManager(BaseManager):
         elif complete is False:
             queryset = queryset.filter(Invoice.status != InvoiceStatus.complete)
 
-        self.transaction, self.invoice = queryset.with_for_update().one()
+        self.transaction, self.invoice = self.for_update(queryset).one()
+        self.transaction_id = self.transaction.id
 
     def create_attempt(self, payment_system_id: int):
         self.fetch(complete=False)
@@ -313,6 +656,7 @@ class TransactionManager(BaseManager):
         self.session.commit()
         return attempt
 
+    @operation(READ_COMMITTED, lock=False)
     def get_payment_info(self):
         self.fetch(complete=False)
         systems = self.session.query(PaymentSystem).all()
@@ -322,12 +666,71 @@ class TransactionManager(BaseManager):
     def refund(self):
         self.fetch(paid=True)
         self.transaction.status = TransactionStatus.refunded
+        self.invoice.paid_amount -= self.transaction.effective_amount
         self.invoice.status = InvoiceStatus.incomplete
         self.session.add_all((self.transaction, self.invoice))
         self.session.commit()
         return self.transaction
 
 
+class BulkRefundManager(BaseManager):
+    '''
+    Refunds many successful transactions with a handful of statements:
+    rows are locked in id order (invoices, then transactions), so concurrent bulk
+    refunds don't deadlock each other, and updated set based, each invoice once
+    '''
+
+    def __init__(self, transaction_ids: list[int]):
+        self.transaction_ids = transaction_ids
+        self.refundable_ids = None
+        super().__init__()
+
+    def fetch(self):
+        paid = select(Transaction.invoice_id)\
+            .filter(Transaction.id.in_(self.transaction_ids))\
+            .filter(Transaction.status == TransactionStatus.success)
+        self.session.execute(
+            select(Invoice.id).filter(Invoice.id.in_(paid)).order_by(Invoice.id).with_for_update()
+        )
+        self.refundable_ids = self.session.execute(
+            select(Transaction.id)
+            .filter(Transaction.id.in_(self.transaction_ids))
+            .filter(Transaction.status == TransactionStatus.success)
+            .order_by(Transaction.id)
+            .with_for_update()
+        ).scalars().all()
+
+    def refund(self) -> list[int]:
+        self.fetch()
+        if not self.refundable_ids:
+            return []
+
+        refunded = update(Transaction)\
+            .filter(Transaction.id.in_(self.refundable_ids))\
+            .values(status=TransactionStatus.refunded)\
+            .returning(Transaction.invoice_id, Transaction.effective_amount)\
+            .cte('refunded')
+        totals = select(
+            refunded.c.invoice_id, func.sum(refunded.c.effective_amount).label('amount')
+        ).group_by(refunded.c.invoice_id).cte('totals')
+        paid_amount = Invoice.paid_amount - totals.c.amount
+        status_type = Invoice.__table__.c.status.type
+        self.session.execute(
+            update(Invoice)
+            .filter(Invoice.id == totals.c.invoice_id)
+            .values(
+                paid_amount=paid_amount,
+                status=cast(case(
+                    (paid_amount >= Invoice.amount, InvoiceStatus.complete.value),
+                    else_=InvoiceStatus.incomplete.value
+                ), status_type)
+            )
+            .execution_options(synchronize_session=False)
+        )
+        self.session.commit()
+        return self.refundable_ids
+
+
 class AttemptManager(BaseManager):
     def __init__(self, attempt_id: int):
         self.attempt_id = attempt_id
@@ -340,22 +743,19 @@ class AttemptManager(BaseManager):
         self.fetch()
 
         self.attempt.status = AttemptStatus.success
-        self.transaction.status = TransactionStatus.success
+        if self.transaction.status != TransactionStatus.success:
+            self.transaction.status = TransactionStatus.success
+            self.invoice.paid_amount += self.transaction.effective_amount
 
-        if self.__is_final_payment(including_self=True):
+        if self.__is_final_payment():
             self.invoice.status = InvoiceStatus.complete
         elif self.invoice.status == InvoiceStatus.pending:
             self.invoice.status = InvoiceStatus.incomplete
 
         self.__update()
 
-    def __is_final_payment(self, including_self=False):
-        paid = sum(t.effective_amount for t in self.other_paid_transactions)
-        if including_self:
-            paid += self.transaction.effective_amount
-        if paid >= self.invoice.amount:
-            return True
-        return False
+    def __is_final_payment(self):
+        return self.invoice.paid_amount >= self.invoice.amount
 
     def fail(self):
         self.fetch()
@@ -369,10 +769,13 @@ class AttemptManager(BaseManager):
 
     def __mark_failed(self, transaction_status: TransactionStatus):
         self.attempt.status = AttemptStatus.fail
+        if self.transaction.status == TransactionStatus.success:
+            self.invoice.paid_amount -= self.transaction.effective_amount
         self.transaction.status = transaction_status
         if self.invoice.status == InvoiceStatus.pending:
             self.invoice.status = InvoiceStatus.incomplete
 
+    @operation(READ_COMMITTED, lock=False)
     def send(self):
         self.fetch()
         system = self.session.query(PaymentSystem).get(self.attempt.payment_system_id)
@@ -392,58 +795,90 @@ class AttemptManager(BaseManager):
         this allows us to lock all three entities at once. otherwise we would need to perform
         2 more queries (attempt & transaction) before locking invoice
         '''
-        self.attempt, self.transaction, self.invoice = \
-            self.session.query(Attempt, Transaction, Invoice)\
-                        .filter(Attempt.id == self.attempt_id, Attempt.status == AttemptStatus.pending)\
-                        .filter(Transaction.id == Attempt.transaction_id)\
-                        .filter(Invoice.id == Transaction.invoice_id)\
-                        .with_for_update()\
-                        .one()
-        self.other_paid_transactions = \
-            self.session.query(Transaction)\
-                        .filter(Transaction.invoice_id == self.invoice.id)\
-                        .filter(Transaction.id != self.transaction.id)\
-                        .filter(Transaction.status == TransactionStatus.success)\
-                        .with_for_update()\
-                        .all()
+        self.attempt, self.transaction, self.invoice = self.for_update(
+            self.session.query(Attempt, Transaction, Invoice)
+                        .filter(Attempt.id == self.attempt_id, Attempt.status == AttemptStatus.pending)
+                        .filter(Transaction.id == Attempt.transaction_id)
+                        .filter(Invoice.id == Transaction.invoice_id)
+        ).one()
 
     def __update(self):
         self.session.add_all((self.attempt, self.transaction, self.invoice))
         self.session.commit()
 
 
+def make_fernet(keys: str) -> MultiFernet:
+    # comma separated keys, the first one is primary, others are still accepted
+    return MultiFernet([Fernet(key.strip().encode()) for key in keys.split(',')])
+
+
+class PaymentSystemRegistry(VersionedCache):
+    '''
+    Payment systems by id along with ready to use fernets,
+    version is bumped on payment system change
+    '''
+    version_model = PaymentSystemVersion
+
+    def load(self, s) -> tuple[dict[int, tuple[PaymentSystem, MultiFernet]]]:
+        systems = {}
+        for system in s.query(PaymentSystem).all():
+            s.expunge(system)
+            try:
+                systems[system.id] = (system, make_fernet(system.decryption_key))
+            except ValueError:
+                logger.exception('invalid decryption key of payment system %s', system.id)
+        return (systems,)
+
+
+payment_systems = PaymentSystemRegistry(poll_interval=PAYMENT_SYSTEMS_POLL_INTERVAL)
+
+
 class VisaManager(BaseManager):
     def __init__(self, payment_system_id: int):
         self.payment_system_id = payment_system_id
-        self.payment = None
+        self.system = None
+        self.fernet = None
         super().__init__()
 
     def fetch(self):
-        self.system = self.session.query(PaymentSystem)\
-                                  .filter(PaymentSystem.system_type == PaymentSystemType.visa)\
-                                  .filter(PaymentSystem.id == self.payment_system_id)\
-                                  .one()
+        _, systems = payment_systems.current()
+        system, fernet = systems.get(self.payment_system_id, (None, None))
+        if system is None or system.system_type != PaymentSystemType.visa:
+            raise NoResultFound(f'No visa payment system {self.payment_system_id}')
+        self.system, self.fernet = system, fernet
 
     def process_response(self, response: Union[str, bytes]):
         self.fetch()
+        self.apply_response(*self.decrypt(response))
 
+    def decrypt(self, response: Union[str, bytes]) -> tuple[bytes, dict]:
         if not isinstance(response, bytes):
             response = response.encode()
 
-        key = self.system.decryption_key
-        if not isinstance(key, bytes):
-            key = key.encode()
-
-        fernet = Fernet(key)
-        raw_response = fernet.decrypt(response)
-        response = json.loads(raw_response)
+        raw_response = self.fernet.decrypt(response)
+        return raw_response, json.loads(raw_response)
+
+    @operation(READ_COMMITTED, lock=False)
+    def enqueue(self, raw_payload: bytes, response: dict):
+        '''stores verified payload to be applied by postback workers'''
+        self.session.add(Postback(
+            payload=raw_payload.decode(),
+            attempt_id=response['attempt_id'],
+            payment_system_id=self.payment_system_id
+        ))
+        self.session.commit()
 
+    def apply_response(self, raw_response: bytes, response: dict) -> bool:
+        '''applies response to pending attempt, repeated responses are ignored'''
         attempt_id = response['attempt_id']
         status = response['status']
 
         with AttemptManager(attempt_id) as manager:
-            manager.fetch()
-            manager.attempt.response = raw_response
+            try:
+                manager.fetch()
+            except NoResultFound:
+                return False
+            manager.attempt.response = raw_response.decode()
             manager.session.add(manager.attempt)
             manager.session.commit()
 
@@ -453,3 +888,92 @@ class VisaManager(BaseManager):
                 manager.fail()
             else:
                 manager.error()
+        return True
+
+
+async def process_postbacks(batch_size: int = POSTBACK_BATCH_SIZE) -> int:
+    '''
+    Applies batch of pending postbacks in order they were received, returns its size.
+    Rows claimed by other workers are skipped, each postback is applied in its own
+    serializable transaction, while batch stays claimed till all of them are done
+    '''
+    async with async_session() as inbox:
+        postbacks = (await inbox.execute(
+            select(Postback)
+            .filter(Postback.status == PostbackStatus.pending)
+            .order_by(Postback.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )).scalars().all()
+
+        for postback in postbacks:
+            try:
+                async with VisaManager(postback.payment_system_id) as manager:
+                    await manager.run(manager.fetch)
+                    raw_response, response = await to_thread.run_sync(
+                        manager.decrypt, postback.payload
+                    )
+                    applied = await manager.run(manager.apply_response, raw_response, response)
+                postback.status = PostbackStatus.applied if applied else PostbackStatus.skipped
+            except Exception as e:
+                logger.exception('failed to apply postback %s', postback.id)
+                postback.status = PostbackStatus.failed
+                postback.error = repr(e)
+            postback.processed_at = now()
+            registry.counter(f'postback.{postback.status.value}').inc()
+
+        await inbox.commit()
+        return len(postbacks)
+
+
+async def postback_queue_depth(session: AsyncSession) -> int:
+    return (await session.execute(
+        select(func.count()).filter(Postback.status == PostbackStatus.pending)
+    )).scalar_one()
+
+
+def compact_wallet(s, wallet_id: int) -> bool:
+    '''
+    Folds wallet's new ledger entries into its amount, returns whether there were any.
+    Runs at read committed: FOR UPDATE waits for transactions holding the row lock
+    entries are appended under, so entries are summed only once all entries with
+    lower ids are committed, and none of them is left behind entry_id
+    '''
+    s.query(Wallet.id).filter(Wallet.id == wallet_id).with_for_update().one()
+    delta, last_id = s.query(func.sum(WalletEntry.delta), func.max(WalletEntry.id))\
+                      .join(Wallet, Wallet.id == WalletEntry.wallet_id)\
+                      .filter(WalletEntry.wallet_id == wallet_id)\
+                      .filter(WalletEntry.id > Wallet.entry_id)\
+                      .one()
+    if last_id is not None:
+        s.execute(
+            update(Wallet)
+            .filter(Wallet.id == wallet_id)
+            .values(amount=Wallet.amount + delta, entry_id=last_id)
+        )
+    s.commit()
+    return last_id is not None
+
+
+async def compact_wallets(batch_size: int = WALLET_COMPACTION_BATCH_SIZE) -> int:
+    '''
+    Compacts wallets with new ledger entries, one short transaction per wallet,
+    returns how many of them were compacted
+    '''
+    async with async_session() as s:
+        # probes (wallet_id, id) index per wallet instead of scanning the ledger
+        wallet_ids = (await s.execute(
+            select(Wallet.id)
+            .filter(select(WalletEntry.id).filter(
+                WalletEntry.wallet_id == Wallet.id, WalletEntry.id > Wallet.entry_id
+            ).exists())
+            .order_by(Wallet.entry_id)  # longest waiting first
+            .limit(batch_size)
+        )).scalars().all()
+        await s.commit()
+
+        compacted = 0
+        for wallet_id in wallet_ids:
+            compacted += await s.run_sync(compact_wallet, wallet_id)
+        registry.counter('wallet.compactions').inc(compacted)
+        return compacted
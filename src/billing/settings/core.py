@@ -3,3 +3,25 @@ from pathlib import Path
 
 ROOT = Path(__file__).parent.parent.resolve()
 HOSTNAME = environ.get('SERVER_HOSTNAME', 'http://localhost:8000/')
+
+# how often workers check whether conversion rates were changed, seconds
+RATES_POLL_INTERVAL = float(environ.get('RATES_POLL_INTERVAL', 1))
+# same for payment systems & their keys
+PAYMENT_SYSTEMS_POLL_INTERVAL = float(environ.get('PAYMENT_SYSTEMS_POLL_INTERVAL', 1))
+
+# seconds verified credentials skip bcrypt check
+AUTH_CACHE_TTL = float(environ.get('AUTH_CACHE_TTL', 60))
+
+# listings whose estimated size is above this report planner estimate instead of exact count
+COUNT_ESTIMATE_THRESHOLD = int(environ.get('COUNT_ESTIMATE_THRESHOLD', 10000))
+
+# manager operations failed with serialization failure or deadlock are retried
+# with jittered exponential backoff starting at MANAGER_RETRY_BACKOFF seconds
+MANAGER_RETRIES = int(environ.get('MANAGER_RETRIES', 5))
+MANAGER_RETRY_BACKOFF = float(environ.get('MANAGER_RETRY_BACKOFF', 0.02))
+
+# postbacks are stored to inbox and applied by `./manage.py postback_workers`
+POSTBACK_QUEUE = environ.get('POSTBACK_QUEUE', '') == '1'
+
+# seconds responses of requests with Idempotency-Key are also kept in worker memory
+IDEMPOTENCY_CACHE_TTL = float(environ.get('IDEMPOTENCY_CACHE_TTL', 600))
@@ -5,10 +5,9 @@ from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from sqlmodel import create_engine, Session
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from plumbum import local
-from cachetools import func
-
-func.ttl_cache = lambda *_, **__: lambda f: f
 
 
 from main import app  # noqa
@@ -24,6 +23,17 @@ import misc, services, views, dependencies  # noqa
 
 test_engine = create_engine(DATABASES['test']['url'])
 test_session = sessionmaker(test_engine, expire_on_commit=False)
+# test client runs every request in its own event loop, connections can't be reused
+test_async_engine = create_async_engine(
+    DATABASES['test_async']['url'], poolclass=NullPool
+)
+test_async_session = sessionmaker(
+    test_async_engine, class_=AsyncSession, expire_on_commit=False
+)
+test_async_serializable_session = sessionmaker(
+    test_async_engine.execution_options(isolation_level='SERIALIZABLE'),
+    class_=AsyncSession, expire_on_commit=False
+)
 test_app = FastAPI()
 test_app.include_router(router)
 test_app.mount("/static", static_files, name="static")
@@ -31,9 +41,12 @@ test_client = TestClient(test_app)
 
 
 misc.main_session = core.session = services.session =\
-    dependencies.session = views.db =\
-        core.serializable_session = services.serializable_session =\
-            test_session
+    core.serializable_session = services.serializable_session =\
+        test_session
+core.async_session = services.async_session = test_async_session
+core.async_serializable_session = services.async_serializable_session =\
+    test_async_serializable_session
+services.conversion_rate_graph.poll_interval = services.payment_systems.poll_interval = 0
 
 
 @pytest.fixture(scope='function')
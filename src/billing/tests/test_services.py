@@ -1,12 +1,98 @@
-from decimal import Decimal
+import json
+import asyncio
+import threading
+from decimal import Decimal, InvalidOperation
+
+import pytest
+import networkx as nx
+from cryptography.fernet import Fernet, InvalidToken
+from sqlalchemy import text, event, func
+from sqlalchemy.exc import OperationalError, NoResultFound
+
+import money
+import services
+from metrics import registry
+from models.core import make_engine
+from models.settings import DATABASES
 
 from models.wallets import Wallet, Currency, ConversionRate
-from models.transactions import Attempt, Transaction, Invoice
+from models.transactions import Attempt, Transaction, Invoice, PaymentSystem, WalletEntry
 from models.accounts import Merchant
-from models.choices import TransactionStatus, InvoiceStatus
+from models.choices import TransactionStatus, InvoiceStatus, AttemptStatus, PaymentSystemType
 from misc import add_user, get_or_create
 from services import InvoiceManager, TransactionManager, AttemptManager,\
-    calculate_conv_rate, calculate_rates
+    VisaManager, ConversionMatrix, ConversionRateGraphCache, calculate_conv_rate, calculate_rates,\
+    wallet_balances
+
+
+def test_conversion_matrix():
+    G = nx.DiGraph()
+    G.add_nodes_from([1, 2, 3, 4, 5])
+    G.add_edge(1, 2, weight=Decimal('2'))
+    G.add_edge(2, 3, weight=Decimal('3'))
+    G.add_edge(1, 4, weight=Decimal('2'))
+    G.add_edge(4, 3, weight=Decimal('0.5'))
+
+    matrix = ConversionMatrix(G)
+
+    assert matrix.rate(1, 1) == Decimal('1')
+    assert matrix.rate(1, 2) == Decimal('2')
+    assert matrix.rate(1, 3) == Decimal('1')
+    assert matrix.path(1, 3) == (1, 4, 3)
+    assert matrix.rate(2, 3) == Decimal('3')
+    assert matrix.rate(3, 1) is None
+    assert matrix.path(3, 1) is None
+    assert matrix.rate(1, 5) is None
+    assert matrix.rate(1, 6) is None
+
+    assert matrix.rates_table[3] == {
+        1: Decimal('1'), 2: Decimal('3'), 3: Decimal('1'), 4: Decimal('0.5')
+    }
+    assert matrix.rates_table[5] == {5: Decimal('1')}
+
+
+def test_money():
+    assert money.parse('10.0005') == Decimal('10.001')  # as postgres rounds numeric
+    assert money.parse(' 7 ') == Decimal('7.000')
+    for value in ('abc', 'NaN', 'Infinity', None, '1e17'):
+        with pytest.raises(InvalidOperation):
+            money.parse(value)
+
+    rate = money.reverse_rate(Decimal('3'))
+    # invoice isn't credited more than paid, payer isn't charged less than credited
+    assert money.convert(Decimal('10'), Decimal('3')) == Decimal('3.333')
+    assert money.convert_back(Decimal('3.333'), Decimal('3')) == Decimal('9.999')
+    assert money.convert(Decimal('1'), rate) == Decimal('3')
+    assert money.convert_back(Decimal('1'), rate) == Decimal('0.334')
+
+
+def test_conversion_rate_graph_cache(session):
+    cache = ConversionRateGraphCache(poll_interval=60)
+    snapshot = cache.get()
+    assert cache.get() is snapshot
+
+    cache.poll_interval = 0
+    snapshot = cache.get()
+    assert cache.get() is snapshot
+
+    currency = session.query(Currency).filter(Currency.code == 'gbp').one()
+    session.query(Currency).filter(Currency.id == currency.id).update({'code': 'gbp'})
+    session.commit()
+    assert cache.get() is not snapshot
+
+
+def test_conversion_rate_graph_cache_poll_error(session, monkeypatch):
+    cache = ConversionRateGraphCache(poll_interval=0)
+    snapshot = cache.get()
+
+    def broken_session():
+        raise OperationalError('SELECT 1', {}, Exception('connection refused'))
+
+    monkeypatch.setattr(services, 'session', broken_session)
+    assert cache.get() is snapshot
+    # nothing to fall back to
+    with pytest.raises(OperationalError):
+        ConversionRateGraphCache(poll_interval=0).get()
 
 
 def test_calculate_conv_rate(session):
@@ -66,6 +152,20 @@ def test_calculate_conv_rate(session):
         4: Decimal('1'), 3: Decimal('2'), 2: Decimal('6'), 1: Decimal('2')
     }
 
+    # rate change is picked up without waiting for any ttl
+    cr.rate = Decimal('4')
+    session.add(cr)
+    session.commit()
+
+    assert calculate_conv_rate(c3.id, c4.id) == Decimal('4')
+    assert calculate_conv_rate(c4.id, c3.id) == Decimal('0.25')
+
+    cr.rate = Decimal('2')
+    session.add(cr)
+    session.commit()
+
+    assert calculate_conv_rate(c3.id, c4.id) == Decimal('2')
+
 
 def test_transaction_success(session):
     merchant = add_user(Merchant, 'test_transaction', 'test_transaction')
@@ -282,13 +382,21 @@ def test_internal_transaction(session):
                                             .filter(Invoice.id == invoice.id)\
                                             .scalar()
 
-    assert Decimal('80') == session.query(Wallet.amount)\
-        .filter(Wallet.id == wallet1.id)\
-        .scalar()
-
-    assert Decimal('120') == session.query(Wallet.amount)\
-        .filter(Wallet.id == wallet2.id)\
-        .scalar()
+    balances = {wallet1.id: Decimal('80'), wallet2.id: Decimal('120')}
+    assert balances == dict(session.execute(wallet_balances(list(balances))).all())
+    # wallets are credited & debited by ledger entries, stored amounts change on compaction
+    assert [Decimal('100'), Decimal('100')] == [
+        amount for amount, in session.query(Wallet.amount)
+                                     .filter(Wallet.id.in_(balances))
+                                     .order_by(Wallet.id)
+    ]
+
+    assert asyncio.run(services.compact_wallets()) >= 2
+    assert not asyncio.run(services.compact_wallets())
+    assert balances == dict(
+        session.query(Wallet.id, Wallet.amount).filter(Wallet.id.in_(balances))
+    )
+    assert balances == dict(session.execute(wallet_balances(list(balances))).all())
 
 
 def test_internal_transaction_conversion(session):
@@ -338,10 +446,453 @@ def test_internal_transaction_conversion(session):
                                             .filter(Invoice.id == invoice.id)\
                                             .scalar()
 
-    assert Decimal('95') == session.query(Wallet.amount)\
-                                   .filter(Wallet.id == wallet1.id)\
-                                   .scalar()
+    assert {wallet1.id: Decimal('95'), wallet2.id: Decimal('200')} == dict(
+        session.execute(wallet_balances([wallet1.id, wallet2.id])).all()
+    )
+
+
+def test_async_managers(session, monkeypatch):
+    uah = session.query(Currency).filter(Currency.code == 'uah').first()
+    usd = session.query(Currency).filter(Currency.code == 'usd').first()
+    merchant = add_user(Merchant, 'test_async_managers', 'test')
+
+    cr = get_or_create(
+        ConversionRate,
+        session=session,
+        from_currency_id=uah.id, to_currency_id=usd.id,
+        defaults=dict(rate='2', allow_reversed=False),
+    )
+    cr.rate = Decimal('2')
+    session.add(cr)
+    session.commit()
+
+    wallet = Wallet(merchant_id=merchant.id, currency_id=usd.id)
+    session.add(wallet)
+    session.commit()
+
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    # sync engine may only be used off event loop (e.g. rates polling in threadpool)
+    loop_thread = threading.current_thread()
+
+    def off_loop(factory):
+        def wrapper(*args, **kwargs):
+            assert threading.current_thread() is not loop_thread
+            return factory(*args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(services, 'session', off_loop(services.session))
+    monkeypatch.setattr(
+        services, 'serializable_session', off_loop(services.serializable_session)
+    )
+
+    transaction_amounts = []
+
+    async def pay():
+        async with InvoiceManager(invoice.id) as manager:
+            transaction = await manager.run(
+                manager.create_transaction, currency_id=uah.id, effective_amount=Decimal('4')
+            )
+        transaction_amounts.append(transaction.amount)
+
+        async with TransactionManager(transaction.id) as tmanager:
+            attempt = await tmanager.run(tmanager.create_attempt, payment_system_id=1)
+            async with AttemptManager(attempt.id) as amanager:
+                assert amanager.async_session is tmanager.async_session
+                await amanager.run(amanager.success)
+
+        async with InvoiceManager(invoice.id) as manager:
+            transaction = await manager.run(
+                manager.create_transaction, currency_id=uah.id, effective_amount=Decimal('6')
+            )
+        transaction_amounts.append(transaction.amount)
+
+        async with TransactionManager(transaction.id) as tmanager:
+            attempt = await tmanager.run(tmanager.create_attempt, payment_system_id=1)
+
+        system = session.query(PaymentSystem).get(1)
+        payload = Fernet(system.decryption_key.encode()).encrypt(
+            json.dumps({'attempt_id': attempt.id, 'status': 'fail'}).encode()
+        )
+        async with VisaManager(1) as manager:
+            await manager.run(manager.fetch)
+            raw_response, response = manager.decrypt(payload)
+            # attempt manager nested in operation shares async connection
+            await manager.run(manager.apply_response, raw_response, response)
+
+        async with InvoiceManager(invoice.id) as manager:
+            return await manager.run(manager.get_payment_info)
+
+    info = asyncio.run(pay())
+    assert transaction_amounts == [Decimal('8'), Decimal('12')]
+    assert info['paid'] == Decimal('4')
+    assert info['unpaid'] == Decimal('6')
+    assert InvoiceStatus.incomplete == session.query(Invoice.status)\
+        .filter(Invoice.id == invoice.id)\
+        .scalar()
+
+    assert [AttemptStatus.success, AttemptStatus.fail] == [
+        status for status, in session.query(Attempt.status)
+                                     .join(Transaction)
+                                     .filter(Transaction.invoice_id == invoice.id)
+                                     .order_by(Attempt.id)
+    ]
+
+
+def test_manager_conflict_retry(session, monkeypatch):
+    monkeypatch.setattr(services, 'MANAGER_RETRY_BACKOFF', 0)
+    merchant = add_user(Merchant, 'test_manager_conflict_retry', 'test_manager_conflict_retry')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1, amount=Decimal('100'))
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('100'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    class Conflict(Exception):
+        pgcode = services.SERIALIZATION_FAILURE
+
+    def counter(name):
+        return registry.snapshot().get(name, 0)
+
+    conflicts, retries = counter('db.conflicts'), counter('db.retries')
+    calls = []
+
+    def flaky(manager, failures):
+        manager.fetch()
+        calls.append(manager.invoice.id)
+        if len(calls) <= failures:
+            raise OperationalError('COMMIT', {}, Conflict())
+        return manager.unpaid_amount
+
+    async def run(failures):
+        async with InvoiceManager(invoice.id) as manager:
+            return await manager.run(flaky, manager, failures)
+
+    assert asyncio.run(run(failures=2)) == Decimal('100')
+    assert len(calls) == 3
+    assert counter('db.conflicts') - conflicts == 2
+    assert counter('db.retries') - retries == 2
+
+    calls.clear()
+    with pytest.raises(OperationalError):
+        asyncio.run(run(failures=services.MANAGER_RETRIES + 1))
+    assert len(calls) == services.MANAGER_RETRIES + 1
+
+    # concurrent postbacks for one invoice conflict on its row
+    attempts = []
+    for _ in range(4):
+        with InvoiceManager(invoice.id) as manager:
+            transaction = manager.create_transaction(1, effective_amount=Decimal('10'))
+        with TransactionManager(transaction.id) as manager:
+            attempts.append(manager.create_attempt(payment_system_id=1).id)
+
+    async def succeed_concurrently():
+        async def succeed(attempt_id):
+            async with AttemptManager(attempt_id) as manager:
+                await manager.run(manager.success)
+        await asyncio.gather(*map(succeed, attempts))
+
+    monkeypatch.undo()  # real backoff, so contenders spread out
+    conflicts = counter('db.conflicts')
+    asyncio.run(succeed_concurrently())
+    assert counter('db.conflicts') > conflicts
+    assert Decimal('40') == session.query(Invoice.paid_amount)\
+        .filter(Invoice.id == invoice.id)\
+        .scalar()
+
+
+def test_operation_isolation(session):
+    merchant = add_user(Merchant, 'test_operation_isolation', 'test_operation_isolation')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    def isolation(manager):
+        return manager.lock, manager.session.execute(text('SHOW transaction_isolation')).scalar()
+
+    read_only = services.operation(services.READ_COMMITTED, lock=False)(isolation)
+
+    async def run():
+        async with InvoiceManager(invoice.id) as manager:
+            return [
+                await manager.run(read_only, manager),
+                await manager.run(isolation, manager),
+                await manager.run(manager.get_payment_info),
+            ]
+
+    # payment in flight holds invoice row, read only operations don't wait for it
+    session.query(Invoice).filter(Invoice.id == invoice.id).with_for_update().one()
+    read_committed, serializable, info = asyncio.run(asyncio.wait_for(run(), timeout=5))
+    session.rollback()
+
+    assert read_committed == (False, 'read committed')
+    assert serializable == (True, 'serializable')
+    assert info['unpaid'] == Decimal('10')
+
+
+def test_managers_by_token(session):
+    merchant = add_user(Merchant, 'test_managers_by_token', 'test_managers_by_token')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa
+    event.listen(session.bind, 'before_cursor_execute', listener)
+    try:
+        with InvoiceManager(token=invoice.token) as manager:
+            transaction = manager.create_transaction(1, effective_amount=Decimal('4'))
+        assert manager.invoice_id == invoice.id
+        # token is resolved & row locked by the fetch itself, no separate lookup
+        assert 'invoice.token =' in statements[0] and 'FOR UPDATE' in statements[0]
+
+        statements.clear()
+        with TransactionManager(token=transaction.token) as manager:
+            attempt = manager.create_attempt(payment_system_id=1)
+        assert manager.transaction_id == transaction.id
+        assert 'transaction.token =' in statements[0] and 'FOR UPDATE' in statements[0]
+    finally:
+        event.remove(session.bind, 'before_cursor_execute', listener)
+
+    assert attempt.transaction_id == transaction.id
+    with pytest.raises(NoResultFound):
+        with TransactionManager(token='unknown') as manager:
+            manager.refund()
+
+
+def test_payment_system_registry(session, monkeypatch):
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    system = PaymentSystem(
+        name='test_payment_system_registry', system_type=PaymentSystemType.visa,
+        decryption_key=old_key.decode()
+    )
+    session.add(system)
+    session.commit()
+
+    def encrypt(key):
+        return Fernet(key).encrypt(json.dumps({'attempt_id': 1, 'status': 'success'}).encode())
+
+    def decrypt(payload):
+        with VisaManager(system.id) as manager:
+            manager.fetch()
+            return manager.decrypt(payload)[1]
+
+    assert decrypt(encrypt(old_key)) == {'attempt_id': 1, 'status': 'success'}
+
+    # config isn't queried while version is fresh
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa
+    event.listen(session.bind, 'before_cursor_execute', listener)
+    monkeypatch.setattr(services.payment_systems, 'poll_interval', 60)
+    try:
+        decrypt(encrypt(old_key))
+        decrypt(encrypt(old_key))
+    finally:
+        event.remove(session.bind, 'before_cursor_execute', listener)
+    assert statements == []
+    monkeypatch.undo()
+
+    # rotation, both keys are accepted until old one is removed
+    system.decryption_key = f'{new_key.decode()},{old_key.decode()}'
+    session.add(system)
+    session.commit()
+    assert decrypt(encrypt(old_key)) == decrypt(encrypt(new_key))
+
+    system.decryption_key = new_key.decode()
+    session.add(system)
+    session.commit()
+    decrypt(encrypt(new_key))
+    with pytest.raises(InvalidToken):
+        decrypt(encrypt(old_key))
+
+    # other tests expect single payment system
+    session.delete(system)
+    session.commit()
+
+
+def test_pool_metrics(monkeypatch):
+    monkeypatch.setitem(DATABASES, 'sync', DATABASES['test'])
+    engine = make_engine('test_pool_metrics', 'write')
+
+    with engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+        snapshot = registry.snapshot()
+        assert snapshot['db.pool.test_pool_metrics.checked_out'] == 1
+        assert snapshot['db.pool.test_pool_metrics.utilisation'] > 0
+
+    snapshot = registry.snapshot()
+    assert snapshot['db.pool.test_pool_metrics.checked_out'] == 0
+    assert snapshot['db.pool.test_pool_metrics.checkout_wait']['count'] == 1
+    engine.dispose()
+
+
+def test_lookup_query_plans(session):
+    def plan(query):
+        sql = query.statement.compile(
+            dialect=session.bind.dialect, compile_kwargs={'literal_binds': True}
+        )
+        return '\n'.join(r[0] for r in session.execute(text(f'EXPLAIN {sql}')))
+
+    # tables are tiny in tests, seq scan would be picked regardless of indexes
+    session.execute(text('SET LOCAL enable_seqscan = off'))
+
+    queries = {
+        'ix_transaction_invoice_id_status': session.query(Transaction)
+            .filter(Transaction.invoice_id == 1)
+            .filter(Transaction.status == TransactionStatus.success),
+        'ix_attempt_transaction_id': session.query(Attempt)
+            .filter(Attempt.transaction_id == 1),
+        'ix_invoice_to_wallet_id': session.query(Invoice)
+            .filter(Invoice.to_wallet_id == 1),
+        'uniq_wallet': session.query(Wallet)
+            .filter(Wallet.merchant_id == 1),
+        'uniq_transaction_token': session.query(Transaction.id)
+            .filter(Transaction.token == 'token'),
+    }
+    for index, query in queries.items():
+        assert index in plan(query)
+        assert 'Seq Scan' not in plan(query)
+    session.rollback()
+
+
+def test_invoice_paid_amount(session):
+    merchant = add_user(Merchant, 'test_invoice_paid_amount', 'test_invoice_paid_amount')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    def paid_amount():
+        return session.query(Invoice.paid_amount).filter(Invoice.id == invoice.id).scalar()
+
+    def pay(effective_amount):
+        with InvoiceManager(invoice.id) as manager:
+            transaction = manager.create_transaction(1, effective_amount=effective_amount)
+        with TransactionManager(transaction.id) as manager:
+            attempt = manager.create_attempt(payment_system_id=1)
+        with AttemptManager(attempt.id) as manager:
+            manager.success()
+        return transaction
+
+    first = pay(Decimal('4'))
+    second = pay(Decimal('6'))
+    assert paid_amount() == Decimal('10')
+
+    with TransactionManager(second.id) as manager:
+        manager.refund()
+    assert paid_amount() == Decimal('4')
+
+    # repeated success postback for paid transaction isn't counted twice
+    with TransactionManager(first.id) as manager:
+        attempt = manager.create_attempt(payment_system_id=1)
+    with AttemptManager(attempt.id) as manager:
+        manager.success()
+    assert paid_amount() == Decimal('4')
+
+    with TransactionManager(first.id) as manager:
+        attempt = manager.create_attempt(payment_system_id=1)
+    with AttemptManager(attempt.id) as manager:
+        manager.fail()
+    assert paid_amount() == Decimal('0')
+
+    with InvoiceManager(invoice.id) as manager:
+        assert manager.get_payment_info()['unpaid'] == Decimal('10')
+
+
+def test_wallet_ledger_credits(session):
+    payer = add_user(Merchant, 'test_wallet_ledger_payer', 'test_wallet_ledger_payer')
+    receiver = add_user(Merchant, 'test_wallet_ledger_receiver', 'test_wallet_ledger_receiver')
+    from_wallet = Wallet(merchant_id=payer.id, currency_id=1, amount=Decimal('10'))
+    to_wallet = Wallet(merchant_id=receiver.id, currency_id=1)
+    session.add_all((from_wallet, to_wallet))
+    session.commit()
+    invoices = [Invoice(amount=Decimal('1'), to_wallet_id=to_wallet.id) for _ in range(2)]
+    session.add_all(invoices)
+    session.commit()
+
+    async def pay(invoice):
+        async with InvoiceManager(invoice.id) as manager:
+            return await manager.run(
+                manager.pay_with_wallet, merchant_id=payer.id, wallet_id=from_wallet.id,
+                effective_amount=Decimal('1')
+            )
+
+    # receiving wallet held by another transaction (e.g. debit) doesn't block credits
+    session.query(Wallet).filter(Wallet.id == to_wallet.id).with_for_update(key_share=True).one()
+    transaction = asyncio.run(asyncio.wait_for(pay(invoices[0]), timeout=5))
+    session.rollback()
+    assert transaction.status == TransactionStatus.success
+
+    # compaction waits for transactions appending entries, so none is left behind watermark
+    assert asyncio.run(pay(invoices[1])).status == TransactionStatus.success
+    session.query(Wallet).filter(Wallet.id == to_wallet.id)\
+        .with_for_update(read=True, key_share=True)\
+        .one()
+    compaction = threading.Thread(target=asyncio.run, args=(services.compact_wallets(),))
+    compaction.start()
+    compaction.join(timeout=0.5)
+    assert compaction.is_alive()
+    session.rollback()
+    compaction.join()
+
+    balances = {from_wallet.id: Decimal('8'), to_wallet.id: Decimal('2')}
+    assert balances == dict(
+        session.query(Wallet.id, Wallet.amount).filter(Wallet.id.in_(balances))
+    )
+    assert balances == dict(session.execute(wallet_balances(list(balances))).all())
+
+
+def test_concurrent_wallet_payments(session):
+    merchants = [
+        add_user(Merchant, f'test_concurrent_wallet_payments_{i}', 'test') for i in range(3)
+    ]
+    wallets = [Wallet(merchant_id=m.id, currency_id=1, amount=Decimal('10')) for m in merchants]
+    session.add_all(wallets)
+    session.commit()
+    # (payer, payee, amount): first two merchants pay each other,
+    # the third one tries to spend its balance twice
+    payments = [(0, 1, '1'), (1, 0, '1'), (0, 1, '1'), (1, 0, '1'), (2, 1, '6'), (2, 1, '6')]
+    invoices = [
+        Invoice(amount=Decimal(amount), to_wallet_id=wallets[payee].id)
+        for _, payee, amount in payments
+    ]
+    session.add_all(invoices)
+    session.commit()
 
-    assert Decimal('200') == session.query(Wallet.amount)\
-                                    .filter(Wallet.id == wallet2.id)\
-                                    .scalar()
+    async def pay(invoice, payer, payee, amount):
+        async with InvoiceManager(invoice.id) as manager:
+            return await manager.run(
+                manager.pay_with_wallet, merchant_id=merchants[payer].id,
+                wallet_id=wallets[payer].id, effective_amount=Decimal(amount)
+            )
+
+    async def pay_concurrently():
+        return await asyncio.gather(*(
+            pay(invoice, *payment) for invoice, payment in zip(invoices, payments)
+        ))
+
+    transactions = asyncio.run(asyncio.wait_for(pay_concurrently(), timeout=30))
+    statuses = [t.status for t in transactions]
+    assert statuses[:4] == [TransactionStatus.success] * 4
+    assert sorted(statuses[4:]) == [TransactionStatus.fail, TransactionStatus.success]
+
+    # every successful payment moved money exactly once, nothing was overspent
+    balances = dict(session.execute(wallet_balances([w.id for w in wallets])).all())
+    assert [balances[w.id] for w in wallets] == [Decimal('10'), Decimal('16'), Decimal('4')]
+    entries = session.query(WalletEntry.transaction_id, func.sum(WalletEntry.delta))\
+        .filter(WalletEntry.transaction_id.in_([t.id for t in transactions]))\
+        .group_by(WalletEntry.transaction_id)\
+        .all()
+    assert sorted(t.id for t in transactions if t.status == TransactionStatus.success) ==\
+        sorted(id for id, delta in entries if delta == 0)
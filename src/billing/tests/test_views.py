@@ -1,12 +1,23 @@
+import json
+import asyncio
 from decimal import Decimal
 from requests.auth import _basic_auth_str
 
+from bcrypt import checkpw as bcrypt_checkpw
+from cryptography.fernet import Fernet
+from sqlalchemy import event, text
+
+import misc
+import views
+import services
+import dependencies
 from misc import add_user, get_or_create
+from models.core import unit_of_work
 from models.accounts import Merchant, Staff
 from models.wallets import Wallet, Currency, ConversionRate
-from models.transactions import Invoice, Transaction, Attempt
-from models.choices import InvoiceStatus
-from services import calculate_rates, AttemptManager, InvoiceManager
+from models.transactions import Invoice, Transaction, Attempt, PaymentSystem, Postback
+from models.choices import InvoiceStatus, AttemptStatus, TransactionStatus, PostbackStatus
+from services import calculate_rates, AttemptManager, InvoiceManager, TransactionManager
 
 
 def basic_auth(model, test_name: str):
@@ -53,7 +64,9 @@ def test_app_session(session, client):
 
     response = client.get('/wallets', headers=auth)
     assert response.status_code == 200
-    assert response.json() == {'data': [], 'itemsCount': 0}
+    assert response.json() == {
+        'data': [], 'itemsCount': 0, 'itemsCountExact': True, 'nextCursor': None
+    }
 
     assert 0 == session.query(Wallet).filter(Wallet.merchant_id == user.id).count()
 
@@ -69,15 +82,17 @@ def test_app_session(session, client):
     response = client.get('/wallets', headers=auth)
     assert response.status_code == 200
     assert response.json() == {'data': [{
-        'id': wallet.id, 'amount': 0.0, 'currency_id': 1, 'merchant_id': user.id
-    }], 'itemsCount': 1}
+        'id': wallet.id, 'amount': 0.0, 'entry_id': 0, 'currency_id': 1, 'merchant_id': user.id
+    }], 'itemsCount': 1, 'itemsCountExact': True, 'nextCursor': None}
 
     response = client.get('/invoices')
     assert response.status_code == 401
 
     response = client.get('/invoices', headers=auth)
     assert response.status_code == 200
-    assert response.json() == {'data': [], 'itemsCount': 0}
+    assert response.json() == {
+        'data': [], 'itemsCount': 0, 'itemsCountExact': True, 'nextCursor': None
+    }
 
     response = client.post('/invoice')
     assert response.status_code == 401
@@ -177,3 +192,438 @@ def test_app_session(session, client):
         manager.fetch()
         assert manager.paid_amount == Decimal('11.1')
         assert manager.invoice.status == InvoiceStatus.incomplete
+
+
+def test_staff_session(session, client):
+    merchant, merchant_auth = basic_auth(Merchant, 'test_staff_session_merchant')
+    staff, staff_auth = basic_auth(Staff, 'test_staff_session_staff')
+
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+
+    response = client.get('/', headers=staff_auth)
+    assert response.status_code == 200
+
+    response = client.post('/wallet', json={'currency_id': 2}, headers=staff_auth)
+    assert response.status_code == 401
+
+    response = client.get('/wallets', headers=merchant_auth)
+    assert [w['id'] for w in response.json()['data']] == [wallet.id]
+
+    response = client.get('/wallets', headers=staff_auth)
+    assert response.status_code == 200
+    assert len(response.json()['data']) == session.query(Wallet).count()
+
+
+def test_visa_response(session, client):
+    user, auth = basic_auth(Merchant, 'test_visa_response')
+    wallet = Wallet(merchant_id=user.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    response = client.post(f'/pay/{invoice.token}', json={'amount': '10', 'currency_id': 1})
+    token = response.json()['token']
+    response = client.post(f'/attempt/{token}', json={'payment_system_id': 1})
+    assert response.status_code == 200
+
+    attempt = session.query(Attempt)\
+                     .filter(Attempt.transaction_id == Transaction.id)\
+                     .filter(Transaction.token == token)\
+                     .one()
+    system = session.query(PaymentSystem).get(1)
+    payload = Fernet(system.decryption_key.encode()).encrypt(
+        json.dumps({'attempt_id': attempt.id, 'status': 'success'}).encode()
+    )
+
+    response = client.post('/visa/1', data=payload)
+    assert response.status_code == 200
+
+    session.expire_all()
+    attempt = session.query(Attempt).get(attempt.id)
+    assert attempt.status == AttemptStatus.success
+    assert json.loads(attempt.response) == {'attempt_id': attempt.id, 'status': 'success'}
+    assert TransactionStatus.success == session.query(Transaction.status)\
+        .filter(Transaction.token == token)\
+        .scalar()
+    assert InvoiceStatus.complete == session.query(Invoice.status)\
+        .filter(Invoice.id == invoice.id)\
+        .scalar()
+
+
+def test_metrics(client):
+    staff, staff_auth = basic_auth(Staff, 'test_metrics_staff')
+    merchant, merchant_auth = basic_auth(Merchant, 'test_metrics_merchant')
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers=merchant_auth).status_code == 401
+
+    response = client.get('/metrics', headers=staff_auth)
+    assert response.status_code == 200
+    metrics = response.json()
+    for pool in ('read', 'write', 'async_read', 'async_write'):
+        assert f'db.pool.{pool}.checked_out' in metrics
+        assert 0 <= metrics[f'db.pool.{pool}.utilisation'] <= 1
+
+
+def test_auth_cache(session, client, monkeypatch):
+    merchant, auth = basic_auth(Merchant, 'test_auth_cache')
+    checks = []
+
+    def checkpw(password, password_hash):
+        checks.append(password)
+        return bcrypt_checkpw(password, password_hash)
+
+    monkeypatch.setattr(dependencies, 'checkpw', checkpw)
+    dependencies.credentials_cache.entries.clear()
+
+    assert client.get('/wallets', headers=auth).status_code == 200
+    assert client.get('/wallets', headers=auth).status_code == 200
+    assert len(checks) == 1
+
+    # wrong password is never cached
+    wrong_auth = {'Authorization': _basic_auth_str('test_auth_cache', 'wrong')}
+    assert client.get('/wallets', headers=wrong_auth).status_code == 401
+    assert client.get('/wallets', headers=wrong_auth).status_code == 401
+    assert len(checks) == 3
+
+    # changed password hash invalidates cached entry
+    merchant = session.query(Merchant).get(merchant.id)
+    merchant.password = add_user(Merchant, 'test_auth_cache_other', 'new').password
+    session.commit()
+    assert client.get('/wallets', headers=auth).status_code == 401
+    assert len(checks) == 4
+
+    # cache entries expire
+    monkeypatch.setattr(dependencies.credentials_cache, 'ttl', -1)
+    _, auth = basic_auth(Staff, 'test_auth_cache_staff')
+    assert client.get('/', headers=auth).status_code == 200
+    assert client.get('/', headers=auth).status_code == 200
+    assert len(checks) == 6
+
+
+def test_pagination(session, client):
+    merchant, auth = basic_auth(Merchant, 'test_pagination')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoices = [Invoice(amount=Decimal(i + 1), to_wallet_id=wallet.id) for i in range(5)]
+    session.add_all(invoices)
+    session.commit()
+    ids = [i.id for i in invoices]
+
+    response = client.get('/invoices?pageIndex=2&pageSize=2', headers=auth)
+    page = response.json()
+    assert [i['id'] for i in page['data']] == ids[2:4]
+    assert page['nextCursor']
+
+    pages, cursor = [], None
+    while True:
+        params = {'pageSize': 2} | ({'cursor': cursor} if cursor else {'pageIndex': 1})
+        page = client.get('/invoices', params=params, headers=auth).json()
+        pages.append([i['id'] for i in page['data']])
+        if not (cursor := page['nextCursor']):
+            break
+    assert pages == [ids[:2], ids[2:4], ids[4:]]
+
+    response = client.get('/invoices', params={'cursor': 'garbage'}, headers=auth)
+    assert response.status_code == 400
+
+
+def test_items_count(session, client, monkeypatch):
+    merchant, auth = basic_auth(Merchant, 'test_items_count')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    session.add_all([Invoice(amount=Decimal(1), to_wallet_id=wallet.id) for _ in range(5)])
+    session.commit()
+
+    for params in ({'pageIndex': 1, 'pageSize': 2}, {'pageIndex': 3, 'pageSize': 2}, {}):
+        page = client.get('/invoices', params=params, headers=auth).json()
+        assert (page['itemsCount'], page['itemsCountExact']) == (5, True)
+
+    cursor = client.get('/invoices?pageIndex=1&pageSize=2', headers=auth).json()['nextCursor']
+    page = client.get('/invoices', params={'cursor': cursor, 'pageSize': 2}, headers=auth).json()
+    assert (page['itemsCount'], page['itemsCountExact']) == (5, True)
+
+    monkeypatch.setattr(misc, 'COUNT_ESTIMATE_THRESHOLD', 0)
+    page = client.get('/invoices?pageIndex=1&pageSize=2', headers=auth).json()
+    assert page['itemsCountExact'] is False
+    assert page['itemsCount'] > 0
+
+
+def test_add_invoices(session, client, monkeypatch):
+    monkeypatch.setattr(services, 'INVOICE_BATCH_SIZE', 2)
+    merchant, auth = basic_auth(Merchant, 'test_add_invoices')
+    other, _ = basic_auth(Merchant, 'test_add_invoices_other')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    other_wallet = Wallet(merchant_id=other.id, currency_id=1)
+    session.add_all((wallet, other_wallet))
+    session.commit()
+
+    items = [
+        {'amount': '10.5', 'to_wallet_id': wallet.id},
+        {'amount': '-1', 'to_wallet_id': wallet.id},
+        {'amount': '3', 'to_wallet_id': other_wallet.id},
+        {'to_wallet_id': wallet.id},
+        {'amount': 7, 'to_wallet_id': wallet.id},
+    ]
+
+    def created(response):
+        assert response.status_code == 200
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    assert client.post('/invoices', json=items).status_code == 401
+    assert client.post('/invoices', json={}, headers=auth).status_code == 400
+
+    results = created(client.post('/invoices', json=items, headers=auth))
+    ndjson = '\n'.join(map(json.dumps, items)).replace('"-1"', 'not json')
+    ndjson_results = created(client.post(
+        '/invoices', data=ndjson,
+        headers=auth | {'Content-Type': 'application/x-ndjson'}
+    ))
+
+    for results in (results, ndjson_results):
+        assert len(results) == len(items)
+        assert [bool(r.get('token')) for r in results] == [True, False, False, False, True]
+        assert results[2] == {'error': 'wallet not found'}
+        invoices = {
+            i.token: i for i in
+            session.query(Invoice).filter(Invoice.token.in_([r.get('token') for r in results]))
+        }
+        assert invoices[results[0]['token']].amount == Decimal('10.5')
+        assert invoices[results[4]['token']].amount == Decimal('7')
+        assert invoices[results[4]['token']].status == InvoiceStatus.pending
+        assert invoices[results[4]['token']].to_wallet_id == wallet.id
+
+
+def test_export_transactions(session, client, monkeypatch):
+    monkeypatch.setattr(views, 'EXPORT_CHUNK_SIZE', 2)
+    merchant, auth = basic_auth(Merchant, 'test_export_transactions')
+    staff, staff_auth = basic_auth(Staff, 'test_export_transactions_staff')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('100'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    transactions = []
+    for i in range(5):
+        with InvoiceManager(invoice.id) as manager:
+            transactions.append(manager.create_transaction(1, effective_amount=Decimal(i + 1)))
+    transactions[0].status = TransactionStatus.fail
+    session.add(transactions[0])
+    session.commit()
+    ids = [t.id for t in transactions]
+
+    def export(params, auth=auth):
+        response = client.get('/transactions/export', params=params, headers=auth)
+        assert response.status_code == 200
+        return response
+
+    rows = [json.loads(line) for line in export({}).text.splitlines()]
+    assert [r['id'] for r in rows] == ids
+    assert rows[1]['effective_amount'] == '2.000'
+    assert rows[0]['status'] == 'fail'
+
+    rows = export({'format': 'csv', 'status': 'pending'}).text.splitlines()
+    assert rows[0].split(',') == list(views.EXPORT_COLUMNS)
+    assert [int(r.split(',')[0]) for r in rows[1:]] == ids[1:]
+
+    since = transactions[2].created_at.isoformat()
+    rows = export({'since': since, 'invoice_id': invoice.id}, staff_auth).text.splitlines()
+    assert [json.loads(r)['id'] for r in rows] == ids[2:]
+
+    other, other_auth = basic_auth(Merchant, 'test_export_transactions_other')
+    params = {'merchant_id': merchant.id}
+    assert export(params, other_auth).text == ''
+    assert len(export(params, staff_auth).text.splitlines()) == 5
+
+
+def test_bulk_refund(session, client):
+    merchant, auth = basic_auth(Merchant, 'test_bulk_refund')
+    staff, staff_auth = basic_auth(Staff, 'test_bulk_refund_staff')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoices = [Invoice(amount=Decimal('20'), to_wallet_id=wallet.id) for _ in range(2)]
+    session.add_all(invoices)
+    session.commit()
+
+    def pay(invoice, effective_amount):
+        with InvoiceManager(invoice.id) as manager:
+            transaction = manager.create_transaction(1, effective_amount=effective_amount)
+        with TransactionManager(transaction.id) as manager:
+            attempt = manager.create_attempt(payment_system_id=1)
+        with AttemptManager(attempt.id) as manager:
+            manager.success()
+        return transaction.token
+
+    paid = [
+        pay(invoices[0], Decimal('4')), pay(invoices[0], Decimal('6')),
+        pay(invoices[1], Decimal('10'))
+    ]
+    with InvoiceManager(invoices[1].id) as manager:
+        pending = manager.create_transaction(1, effective_amount=Decimal('1')).token
+
+    tokens = [paid[0], paid[2], pending, 'unknown']
+    assert client.post('/refunds', json={'tokens': tokens}, headers=auth).status_code == 401
+    response = client.post('/refunds', json={'tokens': tokens}, headers=staff_auth)
+    assert response.json() == {'refunded': [paid[0], paid[2]], 'skipped': [pending, 'unknown']}
+
+    # already refunded ones are skipped
+    response = client.post('/refunds', json={'tokens': tokens}, headers=staff_auth)
+    assert response.json()['refunded'] == []
+
+    session.expire_all()
+    assert [
+        (i.paid_amount, i.status)
+        for i in session.query(Invoice).filter(Invoice.id.in_([i.id for i in invoices]))
+                                       .order_by(Invoice.id)
+    ] == [(Decimal('6'), InvoiceStatus.incomplete), (Decimal('0'), InvoiceStatus.incomplete)]
+    assert {TransactionStatus.refunded} == {
+        status for status, in session.query(Transaction.status)
+                                     .filter(Transaction.token.in_([paid[0], paid[2]]))
+    }
+
+
+def test_postback_queue(session, client, monkeypatch):
+    monkeypatch.setattr(views, 'POSTBACK_QUEUE', True)
+    merchant, auth = basic_auth(Merchant, 'test_postback_queue')
+    staff, staff_auth = basic_auth(Staff, 'test_postback_queue_staff')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    with InvoiceManager(invoice.id) as manager:
+        transaction = manager.create_transaction(1, effective_amount=Decimal('10'))
+    with TransactionManager(transaction.id) as manager:
+        attempt = manager.create_attempt(payment_system_id=1)
+
+    system = session.query(PaymentSystem).get(1)
+    fernet = Fernet(system.decryption_key.encode())
+    payload = fernet.encrypt(json.dumps({'attempt_id': attempt.id, 'status': 'success'}).encode())
+
+    assert client.post('/visa/1', data=payload).status_code == 200
+    # repeated by payment system
+    assert client.post('/visa/1', data=payload).status_code == 200
+    assert client.get('/metrics', headers=staff_auth).json()['postback.queue_depth'] == 2
+    assert AttemptStatus.pending == session.query(Attempt.status)\
+        .filter(Attempt.id == attempt.id)\
+        .scalar()
+
+    assert asyncio.run(services.process_postbacks()) == 2
+    assert asyncio.run(services.process_postbacks()) == 0
+
+    assert client.get('/metrics', headers=staff_auth).json()['postback.queue_depth'] == 0
+    assert [PostbackStatus.applied, PostbackStatus.skipped] == [
+        status for status, in session.query(Postback.status)
+                                     .filter(Postback.attempt_id == attempt.id)
+                                     .order_by(Postback.id)
+    ]
+    assert AttemptStatus.success == session.query(Attempt.status)\
+        .filter(Attempt.id == attempt.id)\
+        .scalar()
+    assert Decimal('10') == session.query(Invoice.paid_amount)\
+        .filter(Invoice.id == invoice.id)\
+        .scalar()
+
+
+def test_idempotency_key(session, client):
+    merchant, auth = basic_auth(Merchant, 'test_idempotency_key')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1)
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    def pay(key, amount='1'):
+        return client.post(
+            f'/pay/{invoice.token}', json={'amount': amount, 'currency_id': 1},
+            headers={'Idempotency-Key': key}
+        )
+
+    first = pay('test_idempotency_key').json()
+    assert pay('test_idempotency_key').json() == first
+    assert pay('test_idempotency_key', amount='2').status_code == 422
+    assert pay('test_idempotency_key_other').json() != first
+    assert 2 == session.query(Transaction).filter(Transaction.invoice_id == invoice.id).count()
+
+    # concurrent duplicates, in one worker and in different ones, run handler once
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return {'called': len(calls)}
+
+    async def run(keys):
+        async with services.async_session() as s:
+            return await keys.run(s, '/test', 'test_idempotency_key', 'hash', handler)
+
+    async def duplicates():
+        worker, other_worker = dependencies.idempotency_keys, misc.IdempotencyKeys(ttl=60)
+        return await asyncio.gather(run(worker), run(worker), run(other_worker))
+
+    assert asyncio.run(duplicates()) == [{'called': 1}] * 3
+    assert len(calls) == 1
+    assert not dependencies.idempotency_keys.locks
+
+
+def test_request_unit_of_work(session, client):
+    merchant, auth = basic_auth(Merchant, 'test_request_unit_of_work')
+    wallet = Wallet(merchant_id=merchant.id, currency_id=1, amount=Decimal('10'))
+    session.add(wallet)
+    session.commit()
+    invoice = Invoice(amount=Decimal('10'), to_wallet_id=wallet.id)
+    session.add(invoice)
+    session.commit()
+
+    checkouts = []
+    listener = lambda *args: checkouts.append(args[0])  # noqa
+    engine = services.async_session.kw['bind'].sync_engine
+    event.listen(engine, 'checkout', listener)
+    try:
+        # auth & manager share request's connection
+        response = client.post(
+            f'/pay/{invoice.token}', json={'amount': '4', 'from_wallet_id': wallet.id},
+            headers=auth
+        )
+        assert response.json()['status'] == TransactionStatus.success
+        assert len(checkouts) == 1
+
+        # idempotency key holds request's transaction open, manager takes own connection
+        checkouts.clear()
+        response = client.post(
+            f'/pay/{invoice.token}', json={'amount': '1', 'from_wallet_id': wallet.id},
+            headers=auth | {'Idempotency-Key': 'test_request_unit_of_work'}
+        )
+        assert response.json()['status'] == TransactionStatus.success
+        assert len(checkouts) > 1
+    finally:
+        event.remove(engine, 'checkout', listener)
+
+    assert Decimal('5') == session.query(Invoice.paid_amount)\
+        .filter(Invoice.id == invoice.id)\
+        .scalar()
+
+    async def isolation_after_manager():
+        async with unit_of_work() as s:
+            async with InvoiceManager(invoice.id) as manager:
+                assert manager.async_session is s
+                await manager.run(manager.fetch)
+                level = await s.execute(text('SHOW transaction_isolation'))
+                assert level.scalar() == 'serializable'
+            assert manager.invoice.id == invoice.id
+            return (await s.execute(text('SHOW transaction_isolation'))).scalar()
+
+    assert asyncio.run(isolation_after_manager()) == 'read committed'
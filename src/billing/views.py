@@ -1,20 +1,34 @@
+import csv
+import json
+from hashlib import sha256
+from io import StringIO
 from typing import Union, Optional
 from decimal import Decimal
+from datetime import datetime
+from enum import Enum
 from urllib.parse import urljoin
 
-from fastapi import APIRouter, Request, Depends, HTTPException, status
+from fastapi import APIRouter, Request, Depends, HTTPException, Query, Header, status
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from settings.core import HOSTNAME
+import money
+from settings.core import HOSTNAME, POSTBACK_QUEUE
 from models.accounts import Merchant, Staff
 from models.wallets import Wallet, Currency
 from models.transactions import Invoice, Transaction, PaymentSystem
-from dependencies import get_user, get_merchant, db_session as db, \
-    paging, templates, try_get_merchant
-from misc import Paginated
+from models.choices import TransactionStatus
+from dependencies import get_user, get_merchant, get_staff, db_session as db, \
+    paging, templates, try_get_merchant, idempotency_keys
+from misc import Paginated, IdempotencyConflict
+from metrics import registry
 from services import InvoiceManager, TransactionManager, AttemptManager,\
-    VisaManager, calculate_rates
+    VisaManager, BulkRefundManager, async_calculate_rates, create_invoices,\
+    postback_queue_depth, wallet_balances
 
 
 router = APIRouter()
@@ -37,6 +51,10 @@ class CreateAttemptRequest(BaseModel):
     payment_system_id: int
 
 
+class BulkRefundRequest(BaseModel):
+    tokens: list[str]
+
+
 class ConversionRateRequest(BaseModel):
     from_currency_id: int
     to_currency_id: int
@@ -48,20 +66,22 @@ class AddInvoiceRequest(BaseModel):
 
 
 @router.get('/')
-def index(
+async def index(
         request: Request,
-        session: Session = Depends(db), user: User = Depends(get_user)
+        session: AsyncSession = Depends(db), user: User = Depends(get_user)
 ):
+    payment_systems = (await session.execute(select(PaymentSystem))).scalars().all()
+    currencies = (await session.execute(select(Currency))).scalars().all()
     ctx = {
         'request': request, 'user': user,
         'pay_url': urljoin(HOSTNAME, 'pay'),
         'payment_systems': ', '.join(
             f'{{id: {s.id}, name: "{s.system_type}"}}'
-            for s in session.query(PaymentSystem).all()
+            for s in payment_systems
         ),
         'currencies': ', '.join(
             f'{{id: {c.id}, name: "{c.code}"}}'
-            for c in session.query(Currency).all()
+            for c in currencies
         )
     }
     if isinstance(user, Staff):
@@ -76,105 +96,249 @@ def index(
 
 
 @router.get('/currencies')
-def currencies(session: Session = Depends(db)):
+async def currencies(session: AsyncSession = Depends(db)):
+    currencies = (await session.execute(select(Currency))).scalars().all()
     return {
-        'currencies': [c.dict() for c in session.query(Currency).all()],
+        'currencies': [c.dict() for c in currencies],
     }
 
 
 @router.get('/rates/{from_currency_id}')
-def rates(from_currency_id: int, session: Session = Depends(db)):
-    return {'rates': calculate_rates(from_currency_id)}
+async def rates(from_currency_id: int):
+    return {'rates': await async_calculate_rates(from_currency_id)}
 
 
 @router.get('/wallets', response_model=Paginated[Wallet])
-def wallets(
+async def wallets(
         paging: dict = Depends(paging),
-        session: Session = Depends(db), user: User = Depends(get_user)
+        session: AsyncSession = Depends(db), user: User = Depends(get_user)
 ):
-    queryset = session.query(Wallet)
+    statement = select(Wallet)
     if not isinstance(user, Staff):
-        queryset = queryset.filter(Wallet.merchant_id == user.id)
-    return Paginated[Wallet].from_queryset(queryset, **paging)
+        statement = statement.filter(Wallet.merchant_id == user.id)
+    page = await Paginated[Wallet].from_select(session, statement, **paging)
+    # stored amount is compacted balance, ledger entries after it are added up
+    balances = dict((await session.execute(wallet_balances([w.id for w in page['data']]))).all())
+    for wallet in page['data']:
+        wallet.amount = balances[wallet.id]
+    return page
 
 
 @router.post('/wallet', response_model=Wallet)
-def add_wallet(
+async def add_wallet(
         add_wallet: AddWalletRequest,
-        session: Session = Depends(db), merchant: Merchant = Depends(get_merchant)
+        session: AsyncSession = Depends(db), merchant: Merchant = Depends(get_merchant)
 ):
     wallet = Wallet(merchant_id=merchant.id, currency_id=add_wallet.currency_id)
     session.add(wallet)
-    session.commit()
+    await session.commit()
     return wallet
 
 
 @router.get('/invoices', response_model=Paginated[Invoice])
-def get_invoices(
+async def get_invoices(
         paging: dict = Depends(paging),
-        session: Session = Depends(db), user: User = Depends(get_user)
+        session: AsyncSession = Depends(db), user: User = Depends(get_user)
 ):
-    queryset = session.query(Invoice)
+    statement = select(Invoice)
     if not isinstance(user, Staff):
-        queryset = queryset.join(Wallet).filter(Wallet.merchant_id == user.id)
-    return Paginated[Invoice].from_queryset(queryset, **paging)
+        statement = statement.join(Wallet, Wallet.id == Invoice.to_wallet_id)\
+                             .filter(Wallet.merchant_id == user.id)
+    return await Paginated[Invoice].from_select(session, statement, **paging)
 
 
 @router.post('/invoice', response_model=Invoice)
-def add_invoice(
+async def add_invoice(
         add_invoice: AddInvoiceRequest,
-        session: Session = Depends(db), merchant: Merchant = Depends(get_merchant)
+        session: AsyncSession = Depends(db), merchant: Merchant = Depends(get_merchant)
 ):
     invoice = Invoice(
-        amount=add_invoice.amount,
+        amount=money.parse(add_invoice.amount),
         to_wallet_id=add_invoice.to_wallet_id
     )
     session.add(invoice)
-    session.commit()
+    await session.commit()
     return invoice
 
 
+def parse_ndjson_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+@router.post('/invoices')
+async def add_invoices(
+        request: Request,
+        session: AsyncSession = Depends(db), merchant: Merchant = Depends(get_merchant)
+):
+    '''
+    Accepts json array or ndjson stream (application/x-ndjson) of AddInvoiceRequest,
+    responds with ndjson line per invoice in the same order: {"token": ...} or {"error": ...}
+    '''
+    if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+        items, tail = [], b''
+        async for chunk in request.stream():
+            *lines, tail = (tail + chunk).split(b'\n')
+            items.extend(parse_ndjson_line(line) for line in lines if line.strip())
+        if tail.strip():
+            items.append(parse_ndjson_line(tail))
+    else:
+        try:
+            items = await request.json()
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Array of invoices expected"
+            )
+
+    # body is read beforehand: streaming response listens to client disconnect
+    results = create_invoices(session, merchant.id, items)
+    return StreamingResponse(
+        (json.dumps(result) + '\n' async for result in results),
+        media_type='application/x-ndjson'
+    )
+
+
 @router.get('/transactions', response_model=Paginated[Transaction])
-def transactions(
+async def transactions(
         paging: dict = Depends(paging),
-        session: Session = Depends(db),
+        session: AsyncSession = Depends(db),
+        user: User = Depends(get_user)
+):
+    statement = select(Transaction)
+    if not isinstance(user, Staff):
+        statement = statement.join(Invoice, Invoice.id == Transaction.invoice_id)\
+                             .join(Wallet, Wallet.id == Invoice.to_wallet_id)\
+                             .filter(Wallet.merchant_id == user.id)
+    return await Paginated[Transaction].from_select(session, statement, **paging)
+
+
+EXPORT_COLUMNS = (
+    'id', 'token', 'transaction_type', 'amount', 'effective_amount', 'status',
+    'invoice_id', 'from_wallet_id', 'created_at'
+)
+# rows fetched from server side cursor at once, memory doesn't depend on export size
+EXPORT_CHUNK_SIZE = 1000
+
+
+def export_value(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+@router.get('/transactions/export')
+async def export_transactions(
+        format: str = Query('ndjson', regex='^(ndjson|csv)$'),
+        merchant_id: Optional[int] = None,
+        invoice_id: Optional[int] = None,
+        status: Optional[TransactionStatus] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        session: AsyncSession = Depends(db),
         user: User = Depends(get_user)
 ):
-    queryset = session.query(Transaction)
     if not isinstance(user, Staff):
-        queryset = queryset.join(Invoice)\
-                           .join(Wallet).filter(Wallet.merchant_id == user.id)
-    return Paginated[Transaction].from_queryset(queryset, **paging)
+        merchant_id = user.id
+
+    statement = select(*(getattr(Transaction, c) for c in EXPORT_COLUMNS))
+    if merchant_id is not None:
+        statement = statement.join(Invoice, Invoice.id == Transaction.invoice_id)\
+                             .join(Wallet, Wallet.id == Invoice.to_wallet_id)\
+                             .filter(Wallet.merchant_id == merchant_id)
+    if invoice_id is not None:
+        statement = statement.filter(Transaction.invoice_id == invoice_id)
+    if status is not None:
+        statement = statement.filter(Transaction.status == status)
+    if since is not None:
+        statement = statement.filter(Transaction.created_at >= since)
+    if until is not None:
+        statement = statement.filter(Transaction.created_at < until)
+    statement = statement.order_by(Transaction.id)\
+                         .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+
+    def row_to_dict(row):
+        return {c: export_value(v) for c, v in row._mapping.items()}
+
+    async def ndjson():
+        result = await session.stream(statement)
+        async for rows in result.partitions():
+            yield ''.join(json.dumps(row_to_dict(row)) + '\n' for row in rows)
+
+    async def csv_lines():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        result = await session.stream(statement)
+        async for rows in result.partitions():
+            writer.writerows(row_to_dict(row).values() for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    if format == 'csv':
+        return StreamingResponse(csv_lines(), media_type='text/csv', headers={
+            'Content-Disposition': 'attachment; filename="transactions.csv"'
+        })
+    return StreamingResponse(ndjson(), media_type='application/x-ndjson')
 
 
 @router.get('/pay/{token}')
-def get_payment_info_invoice(
-        token: str,
-        session: Session = Depends(db)
-):
-    invoice_id, = session.query(Invoice.id).filter(Invoice.token == token).one()
-    with InvoiceManager(invoice_id) as manager:
-        return manager.get_payment_info()
+async def get_payment_info_invoice(token: str):
+    async with InvoiceManager(token=token) as manager:
+        return await manager.run(manager.get_payment_info)
+
+
+async def idempotent(request: Request, session: AsyncSession, key: Optional[str], handler, *body):
+    '''runs handler once per Idempotency-Key, repeated requests get the first response'''
+    if key is None:
+        return await handler()
+
+    request_hash = sha256(json.dumps(
+        jsonable_encoder(body), sort_keys=True
+    ).encode()).hexdigest()
+    try:
+        return await idempotency_keys.run(session, request.url.path, key, request_hash, handler)
+    except IdempotencyConflict:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was used for different request"
+        )
 
 
 @router.post('/pay/{token}')
-def create_transaction(
+async def create_transaction(
         token: str,
         transaction_request: CreateTransactionRequest,
-        session: Session = Depends(db),
+        request: Request,
+        idempotency_key: Optional[str] = Header(None, max_length=255),
+        session: AsyncSession = Depends(db),
         merchant: Optional[User] = Depends(try_get_merchant)
 ):
-    if merchant:
-        invoice_id, = session.query(Invoice.id).filter(Invoice.token == token).one()
-        return create_internal_transaction(merchant.id, invoice_id, transaction_request)
-    else:
-        invoice_id, = session.query(Invoice.id).filter(Invoice.token == token).one()
-        return create_external_transaction(invoice_id, transaction_request)
+    async def handler():
+        if merchant:
+            return await create_internal_transaction(merchant.id, token, transaction_request)
+        else:
+            return await create_external_transaction(token, transaction_request)
+
+    return await idempotent(
+        request, session, idempotency_key, handler,
+        transaction_request, merchant and merchant.id
+    )
 
 
-def create_internal_transaction(
+async def create_internal_transaction(
         merchant_id,
-        invoice_id,
+        token,
         request
 ):
     if request.from_wallet_id is None:
@@ -188,19 +352,20 @@ def create_internal_transaction(
             detail={'detail': [detail]}
         )
 
-    with InvoiceManager(invoice_id) as manager:
-        transaction = manager.pay_with_wallet(
+    async with InvoiceManager(token=token) as manager:
+        transaction = await manager.run(
+            manager.pay_with_wallet,
             merchant_id=merchant_id,
             wallet_id=request.from_wallet_id,
-            effective_amount=Decimal(request.amount)
+            effective_amount=money.parse(request.amount)
         )
         if transaction:
             return {'transaction': transaction.id, 'status': transaction.status}
         return {'error': 'transaction creation failed'}
 
 
-def create_external_transaction(
-        invoice_id,
+async def create_external_transaction(
+        token,
         request
 ):
     if request.currency_id is None:
@@ -214,10 +379,11 @@ def create_external_transaction(
             detail={'detail': [detail]}
         )
 
-    with InvoiceManager(invoice_id) as manager:
-        transaction = manager.create_transaction(
+    async with InvoiceManager(token=token) as manager:
+        transaction = await manager.run(
+            manager.create_transaction,
             currency_id=request.currency_id,
-            amount=Decimal(request.amount)
+            amount=money.parse(request.amount)
         )
         if transaction:
             return {
@@ -228,36 +394,51 @@ def create_external_transaction(
 
 
 @router.get('/attempt/{token}')
-def get_payment_info_transaction(
-        token: str,
-        session: Session = Depends(db)
-):
-    transaction_id, = session.query(Transaction.id).filter(Transaction.token == token).one()
-    with TransactionManager(transaction_id) as manager:
-        return manager.get_payment_info()
+async def get_payment_info_transaction(token: str):
+    async with TransactionManager(token=token) as manager:
+        return await manager.run(manager.get_payment_info)
 
 
 @router.post('/attempt/{token}')
-def create_attempt(
+async def create_attempt(
         token: str,
         attempt_request: CreateAttemptRequest,
-        session: Session = Depends(db)
+        request: Request,
+        idempotency_key: Optional[str] = Header(None, max_length=255),
+        session: AsyncSession = Depends(db)
 ):
-    transaction_id, = session.query(Transaction.id).filter(Transaction.token == token).one()
-    with TransactionManager(transaction_id) as tmanager:
-        attempt = tmanager.create_attempt(payment_system_id=attempt_request.payment_system_id)
-        with AttemptManager(attempt.id) as amanager:
-            return amanager.send()
+    async def handler():
+        async with TransactionManager(token=token) as tmanager:
+            attempt = await tmanager.run(
+                tmanager.create_attempt, payment_system_id=attempt_request.payment_system_id
+            )
+            async with AttemptManager(attempt.id) as amanager:
+                return await amanager.run(amanager.send)
+
+    return await idempotent(request, session, idempotency_key, handler, attempt_request)
 
 
 @router.post('/refund/{token}', response_model=Transaction)
-def refund(
-        token: str,
-        session: Session = Depends(db)
+async def refund(token: str):
+    async with TransactionManager(token=token) as manager:
+        return await manager.run(manager.refund)
+
+
+@router.post('/refunds')
+async def bulk_refund(
+        refund_request: BulkRefundRequest,
+        session: AsyncSession = Depends(db), staff: Staff = Depends(get_staff)
 ):
-    transaction_id, = session.query(Transaction.id).filter(Transaction.token == token).one()
-    with TransactionManager(transaction_id) as manager:
-        return manager.refund()
+    transactions = dict((await session.execute(
+        select(Transaction.id, Transaction.token)
+        .filter(Transaction.token.in_(refund_request.tokens))
+    )).all())
+    async with BulkRefundManager(list(transactions)) as manager:
+        refunded = {transactions[id] for id in await manager.run(manager.refund)}
+    return {
+        'refunded': [t for t in refund_request.tokens if t in refunded],
+        'skipped': [t for t in refund_request.tokens if t not in refunded]
+    }
 
 
 @router.post('/visa/{payment_system_id}')
@@ -266,6 +447,20 @@ async def visa_response(
         request: Request
 ):
     body = await request.body()
-    with VisaManager(payment_system_id) as manager:
-        manager.process_response(body)
+    async with VisaManager(payment_system_id) as manager:
+        await manager.run(manager.fetch)
+        # decryption is cpu bound, it also verifies payload
+        raw_response, response = await run_in_threadpool(manager.decrypt, body)
+        if POSTBACK_QUEUE:
+            await manager.run(manager.enqueue, body, response)
+        else:
+            await manager.run(manager.apply_response, raw_response, response)
     return {}
+
+
+@router.get('/metrics')
+async def metrics(session: AsyncSession = Depends(db), staff: Staff = Depends(get_staff)):
+    # inbox is shared by all workers, so its depth is read from db
+    return registry.snapshot() | {
+        'postback.queue_depth': await postback_queue_depth(session)
+    }